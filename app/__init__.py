@@ -1,16 +1,16 @@
 from flask import Flask, request
 from config import Config
-from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_login import LoginManager
 from flask_mail import Mail
 from flask_bootstrap import Bootstrap
 from flask_moment import Moment
 from flask_babel import Babel
+from app.database import RoutingSQLAlchemy
 
 app = Flask(__name__)
 app.config.from_object(Config)
-db = SQLAlchemy(app)
+db = RoutingSQLAlchemy(app)  # SQLite engine profiles, see app/database.py
 migrate = Migrate(app, db)
 # With the extension initialized, a bootstrap/base.html template becomes available,
 # and can be referenced from application templates with the extends clause.
@@ -22,8 +22,16 @@ babel = Babel(app) # for translation
 mail = Mail(app)
 login = LoginManager(app)
 login.login_view = "login"  # to tell flask-login what is the view function/endpoint. Chapter 5. uSED BY @login_required to force login users.
-from app import routes, models
+
+from app.profiling import timed
 
 @babel.localeselector
+@timed("locale")
 def get_locale():
-    return request.accept_languages.best_match(app.config['LANGUAGES'])
\ No newline at end of file
+    return request.accept_languages.best_match(app.config['LANGUAGES'])
+
+# instrumentation goes first, so its before_request hook sees every query of the request
+from app import instrumentation, routes, models, cli
+from app.api import bp as api_bp
+
+app.register_blueprint(api_bp, url_prefix="/api")
\ No newline at end of file
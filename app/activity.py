@@ -0,0 +1,75 @@
+import atexit
+from datetime import datetime, timedelta
+from threading import Event, Lock, Thread
+
+from sqlalchemy import bindparam
+from sqlalchemy.orm.attributes import set_committed_value
+
+from app import app, db
+from app.models import User, CachedUser
+
+
+# Writing user.last_seen and committing on every request means every page view, even a plain
+# read, takes SQLite's write lock. Instead, before_request only records the time in memory, and a
+# background thread writes all the pending times in one bulk UPDATE every LAST_SEEN_FLUSH_INTERVAL
+# seconds. Times are only recorded when the stored one is older than LAST_SEEN_GRANULARITY, so a
+# user clicking through pages causes at most one write per granularity period.
+
+
+class LastSeenTracker:
+    def __init__(self, granularity, interval):
+        self.granularity = timedelta(seconds=granularity)
+        self.interval = interval
+        self._pending = {}  # user id -> last seen
+        self._lock = Lock()
+        self._stopped = Event()
+        self._thread = None
+
+    def touch(self, user, now=None):
+        now = now or datetime.utcnow()
+        if user.last_seen is not None and now - user.last_seen < self.granularity:
+            return
+        with self._lock:
+            self._pending[user.id] = now
+            if self._thread is None:
+                self._thread = Thread(target=self._run, daemon=True)
+                self._thread.start()
+        if isinstance(user, CachedUser):
+            user.set_last_seen(now)
+        else:
+            # update the loaded object without marking it as modified, so the next
+            # db.session.commit() of the request does not write it as well
+            set_committed_value(user, "last_seen", now)
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        db.engine.execute(
+            User.__table__.update()
+            .where(User.id == bindparam("user_id"))
+            .values(last_seen=bindparam("seen")),
+            [{"user_id": id, "seen": seen} for id, seen in pending.items()],
+        )
+        return len(pending)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self._safe_flush()
+
+    def _safe_flush(self):
+        try:
+            self.flush()
+        except Exception:
+            app.logger.exception("Could not write last_seen times")
+
+    def stop(self):
+        self._stopped.set()
+        self._safe_flush()
+
+
+last_seen = LastSeenTracker(
+    app.config["LAST_SEEN_GRANULARITY"], app.config["LAST_SEEN_FLUSH_INTERVAL"]
+)
+atexit.register(last_seen.stop)
@@ -0,0 +1,6 @@
+from flask import Blueprint
+
+# The JSON API lives in its own blueprint, registered under the /api/ URL prefix.
+bp = Blueprint("api", __name__)
+
+from app.api import timelines
@@ -0,0 +1,161 @@
+import json
+
+from flask import Response, request, stream_with_context
+from flask_login import current_user, login_required
+
+from app import app, db
+from app.api import bp
+from app.models import User, Post, AVATAR_URL, gravatar_hash, followers
+from app.pagination import newest_first, decode_cursor, encode_cursor
+
+
+# Timelines and follower lists as JSON.
+# The rows are streamed to the client as they come out of the database cursor: nothing builds
+# the whole list in memory, so asking for a million posts uses as much memory as asking for ten.
+# The default format is NDJSON (one JSON object per line); ?format=json sends a JSON array instead.
+# Every item carries the cursor that continues the listing after it, to be sent back as ?before=.
+# ?limit= caps the number of items, up to API_MAX_LIMIT (0 means no cap).
+
+POST_COLUMNS = (
+    Post.id,
+    Post.body,
+    Post.timestamp,
+    User.id,
+    User.username,
+    User.avatar_hash,
+    User.email,
+)
+USER_COLUMNS = (
+    User.id,
+    User.username,
+    User.avatar_hash,
+    User.email,
+    User.about_me,
+    User.last_seen,
+)
+
+dumps = json.JSONEncoder(ensure_ascii=False, separators=(",", ":")).encode
+
+
+def avatar(avatar_hash, email):
+    # the same as User.avatar(), for users whose digest has not been stored yet
+    return AVATAR_URL.format(avatar_hash or gravatar_hash(email), 128)
+
+
+def post_row(row):
+    id, body, timestamp, author_id, username, avatar_hash, email = row
+    return {
+        "id": id,
+        "body": body,
+        "timestamp": timestamp.isoformat() + "Z",
+        "author": {
+            "id": author_id,
+            "username": username,
+            "avatar": avatar(avatar_hash, email),
+        },
+        "cursor": encode_cursor(timestamp, id),
+    }
+
+
+def user_row(row):
+    id, username, avatar_hash, email, about_me, last_seen = row
+    return {
+        "id": id,
+        "username": username,
+        "avatar": avatar(avatar_hash, email),
+        "about_me": about_me,
+        "last_seen": last_seen.isoformat() + "Z" if last_seen else None,
+        "cursor": str(id),
+    }
+
+
+def stream(query, serialize, batch_size=100):
+    """Send the rows of query as NDJSON or as a JSON array, batch_size items per chunk."""
+    array = request.args.get("format") == "json"
+    limit = request.args.get("limit", app.config["API_DEFAULT_LIMIT"], type=int)
+    max_limit = app.config["API_MAX_LIMIT"]
+    if max_limit and not 0 < limit <= max_limit:
+        limit = max_limit
+    if limit > 0:
+        query = query.limit(limit)
+    # stream_results asks for a server-side cursor from drivers that have them (e.g. psycopg2)
+    result = db.session.execute(query.statement.execution_options(stream_results=True))
+
+    def generate():
+        separator = "," if array else "\n"
+        chunk = ["["] if array else []
+        first = True
+        for row in result:
+            if not first and array:
+                chunk.append(separator)
+            chunk.append(dumps(serialize(row)))
+            if not array:
+                chunk.append(separator)
+            first = False
+            if len(chunk) >= batch_size:
+                yield "".join(chunk)
+                chunk = []
+        if array:
+            chunk.append("]")
+        yield "".join(chunk)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="application/json" if array else "application/x-ndjson",
+    )
+
+
+def post_stream(query, order_by=(Post.timestamp, Post.id)):
+    before = request.args.get("before", type=decode_cursor)
+    return stream(newest_first(query, order_by, before), post_row)
+
+
+def user_stream(query):
+    # follower lists are listed by user id, newest accounts first
+    before = request.args.get("before", type=int)
+    if before is not None:
+        query = query.filter(User.id < before)
+    return stream(query.order_by(User.id.desc()), user_row)
+
+
+@bp.route("/timeline")
+@login_required
+def timeline():
+    query = current_user.followed_posts().join(User, Post.author)
+    return post_stream(
+        query.with_entities(*POST_COLUMNS), current_user.followed_posts_order()
+    )
+
+
+@bp.route("/explore")
+@login_required
+def explore():
+    return post_stream(Post.query.join(User, Post.author).with_entities(*POST_COLUMNS))
+
+
+@bp.route("/users/<username>/posts")
+@login_required
+def user_posts(username):
+    user = User.query.filter_by(username=username).first_or_404()
+    query = Post.query.join(User, Post.author).filter(Post.user_id == user.id)
+    return post_stream(query.with_entities(*POST_COLUMNS))
+
+
+@bp.route("/users/<username>/followers")
+@login_required
+def user_followers(username):
+    user = User.query.filter_by(username=username).first_or_404()
+    query = User.query.join(followers, followers.c.follower_id == User.id).filter(
+        followers.c.followed_id == user.id
+    )
+    return user_stream(query.with_entities(*USER_COLUMNS))
+
+
+@bp.route("/users/<username>/followed")
+@login_required
+def user_followed(username):
+    user = User.query.filter_by(username=username).first_or_404()
+    query = User.query.join(followers, followers.c.followed_id == User.id).filter(
+        followers.c.follower_id == user.id
+    )
+    return user_stream(query.with_entities(*USER_COLUMNS))
@@ -0,0 +1,66 @@
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+
+# A small in-process cache shared by all the requests handled by one worker process.
+# Entries expire after `ttl` seconds, and once `maxsize` entries are stored the least recently
+# used one is evicted, so memory use stays bounded no matter how many users hit the site.
+# A lock is needed because the development server and most WSGI servers use threads.
+
+MISSING = object()
+
+
+class TTLCache:
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires, value), oldest first
+        self._lock = Lock()
+
+    def get(self, key, default=MISSING):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            if item[0] < monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return item[1]
+
+    def set(self, key, value, ttl=None):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (monotonic() + (ttl or self.ttl), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def replace(self, key, old, new):
+        """Store new under key if old is still there, without changing when it expires."""
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[1] is not old:
+                return False
+            self._data[key] = (item[0], new)
+            return True
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def delete_where(self, predicate):
+        """Remove every key for which predicate(key) is true. Goes through all the entries."""
+        with self._lock:
+            for key in [key for key in self._data if predicate(key)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
@@ -0,0 +1,261 @@
+import csv
+import json
+import time
+from datetime import datetime
+
+import click
+
+from app import app, db
+from app.database import copy_sqlite
+from app.models import (
+    User,
+    Post,
+    followers,
+    gravatar_hash,
+    rebuild_timelines,
+    reconcile_counters,
+)
+from app.search import reindex
+from app.suggestions import compute_suggestions
+
+
+# Custom commands are registered on app.cli and become available through the flask command,
+# for example `flask timeline backfill`. A group lets related commands share a common prefix.
+@app.cli.group()
+def timeline():
+    """Home timeline maintenance commands."""
+    pass
+
+
+@timeline.command()
+def backfill():
+    """Rebuild the materialized timelines from the followers and post tables."""
+    if app.config["TIMELINE_MODEL"] != "fanout":
+        click.echo(
+            "Warning: TIMELINE_MODEL is not 'fanout', timelines will not be kept up to date."
+        )
+    rows = rebuild_timelines()
+    click.echo("Timeline backfilled with {} rows.".format(rows))
+
+
+@app.cli.group()
+def counters():
+    """User post and follow counter commands."""
+    pass
+
+
+@counters.command()
+def reconcile():
+    """Recount posts and follows, and repair the user counters that drifted."""
+    click.echo("Fixed the counters of {} users.".format(reconcile_counters()))
+
+
+@app.cli.group("suggestions")
+def suggestions_group():
+    """Who to follow suggestion commands."""
+    pass
+
+
+@suggestions_group.command()
+@click.option(
+    "--block-size", default=10000, show_default=True, help="Users per sparse product."
+)
+def compute(block_size):
+    """Recompute the who to follow suggestions of every user from the follower graph."""
+    report = compute_suggestions(app.config["SUGGESTIONS_PER_USER"], block_size)
+    click.echo(
+        "{} suggestions for {} users from {} follows: loaded in {:.1f}s, "
+        "computed in {:.1f}s, written in {:.1f}s ({:.1f}s in total).".format(
+            report["suggestions"],
+            report["users_with_suggestions"],
+            report["edges"],
+            report["load_seconds"],
+            report["compute_seconds"],
+            report["write_seconds"],
+            report["total_seconds"],
+        )
+    )
+
+
+@app.cli.group()
+def replica():
+    """Read replica commands."""
+    pass
+
+
+@replica.command()
+def sync():
+    """Copy the primary SQLite database over the replica, for trying out replicas locally."""
+    replica_uri = app.config["SQLALCHEMY_REPLICA_URI"]
+    if not replica_uri:
+        raise click.UsageError("DATABASE_REPLICA_URL is not set.")
+    try:
+        copy_sqlite(app.config["SQLALCHEMY_DATABASE_URI"], replica_uri, app.root_path)
+    except ValueError as e:
+        raise click.UsageError(
+            "{}, other databases have their own replication.".format(e)
+        )
+    click.echo("Replica updated.")
+
+
+# Bulk data loading and dumping.
+# Adding ORM objects one at a time with db.session.add() takes hours for millions of posts, so these
+# commands stream the input file and send the rows with executemany() in batches, each batch in its
+# own transaction. The files are CSV (with a header line) or NDJSON, chosen from the extension
+# unless --format is given, and "-" means stdin/stdout. The column names are those of the tables.
+
+TABLES = {"users": User.__table__, "posts": Post.__table__, "followers": followers}
+
+
+def file_format(filename, format):
+    return format or ("csv" if filename.endswith(".csv") else "ndjson")
+
+
+def converters(table):
+    def parse_datetime(value):
+        for pattern in ("%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S"):
+            try:
+                return datetime.strptime(value.rstrip("Z").replace(" ", "T"), pattern)
+            except ValueError:
+                pass
+        raise ValueError("invalid date: {}".format(value))
+
+    types = {}
+    for column in table.columns:
+        python_type = column.type.python_type
+        types[column.name] = parse_datetime if python_type is datetime else python_type
+    return types
+
+
+def read_rows(f, format, table):
+    types = converters(table)
+    records = (
+        csv.DictReader(f)
+        if format == "csv"
+        else (json.loads(l) for l in f if l.strip())
+    )
+    for record in records:
+        row = {}
+        for name, value in record.items():
+            if name not in types:
+                raise click.BadParameter("{} has no column {}".format(table.name, name))
+            # CSV has no null, an empty field is one
+            if value is None or value == "":
+                row[name] = None
+            elif isinstance(value, str):
+                row[name] = types[name](value)
+            else:
+                row[name] = value
+        if table is User.__table__ and row.get("email") and not row.get("avatar_hash"):
+            row["avatar_hash"] = gravatar_hash(row["email"])
+        yield row
+
+
+def batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def report(verb, count, started):
+    elapsed = time.perf_counter() - started
+    click.echo(
+        "{} {} rows in {:.1f}s ({:.0f} rows/s)".format(
+            verb, count, elapsed, count / elapsed if elapsed else 0
+        ),
+        err=True,
+    )
+
+
+@app.cli.group()
+def data():
+    """Bulk import and export of users, posts and followers."""
+    pass
+
+
+@data.command("import")
+@click.argument("table", type=click.Choice(sorted(TABLES)))
+@click.argument("file", type=click.File("r"))
+@click.option(
+    "--format",
+    type=click.Choice(["csv", "ndjson"]),
+    help="Default: from the extension.",
+)
+@click.option("--batch-size", default=10000, show_default=True, help="Rows per INSERT.")
+@click.option(
+    "--defer-indexes",
+    is_flag=True,
+    help="Drop the secondary indexes of the table during the load, and build them at the end.",
+)
+def import_(table, file, format, batch_size, defer_indexes):
+    """Load rows from FILE into TABLE."""
+    name, table = table, TABLES[table]
+    indexes = list(table.indexes) if defer_indexes else []
+    for index in indexes:
+        index.drop(bind=db.engine)
+
+    started = time.perf_counter()
+    count = 0
+    try:
+        for batch in batches(
+            read_rows(file, file_format(file.name, format), table), batch_size
+        ):
+            with db.engine.begin() as conn:
+                conn.execute(table.insert(), batch)
+            count += len(batch)
+            click.echo("{} rows...".format(count), err=True)
+    finally:
+        if indexes:
+            click.echo("Building indexes...", err=True)
+        for index in indexes:
+            index.create(bind=db.engine)
+    report("Imported", count, started)
+
+    # tables derived from the imported rows
+    if name == "posts":
+        reindex()
+    click.echo("Fixed the counters of {} users.".format(reconcile_counters()), err=True)
+    if name in ("posts", "followers") and app.config["TIMELINE_MODEL"] == "fanout":
+        rebuild_timelines()
+
+
+@data.command("export")
+@click.argument("table", type=click.Choice(sorted(TABLES)))
+@click.argument("file", type=click.File("w"))
+@click.option(
+    "--format",
+    type=click.Choice(["csv", "ndjson"]),
+    help="Default: from the extension.",
+)
+def export(table, file, format):
+    """Dump the rows of TABLE to FILE."""
+    table = TABLES[table]
+    names = [column.name for column in table.columns]
+    csv_format = file_format(file.name, format) == "csv"
+    if csv_format:
+        writer = csv.writer(file)
+        writer.writerow(names)
+
+    def value(v):
+        return v.isoformat() if isinstance(v, datetime) else v
+
+    started = time.perf_counter()
+    count = 0
+    result = db.engine.execute(
+        db.select([table])
+        .order_by(*table.primary_key)
+        .execution_options(stream_results=True)
+    )
+    for row in result:
+        values = [value(v) for v in row]
+        if csv_format:
+            writer.writerow(values)
+        else:
+            file.write(json.dumps(dict(zip(names, values))) + "\n")
+        count += 1
+    report("Exported", count, started)
@@ -0,0 +1,83 @@
+from functools import wraps
+from hashlib import sha1
+from time import time
+
+from flask import request, session, make_response
+from flask_login import current_user
+
+from app import app, get_locale
+
+
+# HTTP conditional GET.
+# Browsers (and feed readers polling the timelines) send back the ETag and Last-Modified of the
+# copy they have in If-None-Match / If-Modified-Since. If nothing the page shows has changed, the
+# view can answer "304 Not Modified" with an empty body, and skip the post query and the template.
+#
+# What a page shows is summarized by a validator function: it returns the time of the newest change
+# (usually the newest post, found with an indexed MAX()) plus anything else the page depends on.
+# The ETag also covers the URL (so the page cursor), the locale and the viewer, including the time
+# the viewer last followed or unfollowed someone.
+#
+# On the home and explore pages, the validators do not look at the authors of the posts: when one
+# of them changes their username or avatar, browsers keep showing the old ones until a new post or
+# follow changes the ETag. A profile page covers its own user, who wrote all the posts on it.
+#
+# Last-Modified / If-Modified-Since are only used when the page depends on nothing but that time.
+# Counts, the viewer's username, the suggestions panel... can change without it moving, and a
+# browser that only has the date would be told its copy is fresh, so those pages use the ETag alone.
+
+
+def conditional(validator):
+    """validator(**view_args) -> (last_modified or None, tuple of other values the page shows)."""
+
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            # flashed messages are only shown once, so those pages always have to be rendered
+            if request.method != "GET" or "_flashes" in session:
+                return f(*args, **kwargs)
+            last_modified, parts = validator(**kwargs)
+            if current_user.is_authenticated:
+                changes = [last_modified, current_user.follows_changed_at]
+                last_modified = max((c for c in changes if c), default=None)
+                parts += (current_user.id, current_user.username)
+            etag = sha1(
+                repr((request.full_path, get_locale(), last_modified, parts)).encode(
+                    "utf-8"
+                )
+            ).hexdigest()
+
+            if request.if_none_match:
+                fresh = request.if_none_match.contains(etag)
+            elif request.if_modified_since and last_modified and not parts:
+                # HTTP dates have no fractions of a second
+                fresh = (
+                    last_modified.replace(microsecond=0) <= request.if_modified_since
+                )
+            else:
+                fresh = False
+            response = (
+                app.response_class(status=304)
+                if fresh
+                else make_response(f(*args, **kwargs))
+            )
+            response.set_etag(etag)
+            if last_modified and not parts:
+                response.last_modified = last_modified
+            # the pages are different for every user, and must be revalidated on every use
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+def csrf_period():
+    """
+        Pages with a form embed a CSRF token that expires, so their ETag has to change
+        before that happens. This number changes every half of the token lifetime.
+    """
+    limit = app.config.get("WTF_CSRF_TIME_LIMIT", 3600)
+    return int(time() // (limit / 2)) if limit else 0
@@ -0,0 +1,198 @@
+import os
+import sqlite3
+from time import time
+
+from flask import current_app, g, has_app_context, has_request_context, request
+from flask import session as cookie
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import create_engine, event, orm
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.dml import UpdateBase
+
+
+# SQLite engine profiles, selected with SQLITE_PROFILE.
+#
+# "default" leaves SQLite as it comes: a rollback journal, so a reader waits while anything is
+# being committed, and a new connection for every session.
+#
+# "wal" is meant for serving a file database from several threads. Every connection gets
+#     journal_mode=WAL       readers see the last commit and are never blocked by the writer
+#     busy_timeout           a second writer (another process, the CLI) waits instead of failing
+#     synchronous=NORMAL     in WAL mode, only the last commits can be lost on power loss
+#     mmap_size, cache_size  pages are read from memory instead of with read() calls
+# All writes go through a single writer connection (pool of 1): SQLite has one write lock per
+# database anyway, and queueing for the connection is cheaper than spinning on SQLITE_BUSY. The
+# queries of requests go to a pool of SQLITE_READERS query_only connections until the session
+# flushes something. From there to the commit, the transaction stays on the writer so it reads its
+# own changes, which keeps the time a request holds the writer short: a POST /login does not keep
+# it while the password is hashed. Everything outside requests (CLI, background threads) uses the
+# writer.
+#
+# Replica: with SQLALCHEMY_REPLICA_URI, the reads of GET, HEAD and OPTIONS requests (load_user()
+# included) go to that database instead, and everything else to the primary. A replica lags
+# behind, so the other requests read from the primary, which their writes are checked against, and
+# a user who has just written (posted, followed, ...) reads from the primary for the next
+# REPLICA_STICKY_SECONDS too, so they see their own changes. The deadline travels in the session
+# cookie, so it holds whichever process serves the next request. Keeping the replica up to date is
+# the job of the database (streaming replication...). For two SQLite files, `flask replica sync`
+# copies the primary over the replica. Values cached for other users (follow graph, session users)
+# can come from the replica, and be as old as the replication lag plus their TTL.
+
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+
+def wal_pragmas(config):
+    return [
+        ("journal_mode", "WAL"),
+        ("busy_timeout", int(config["SQLITE_BUSY_TIMEOUT"] * 1000)),
+        ("synchronous", "NORMAL"),
+        ("mmap_size", config["SQLITE_MMAP_SIZE"]),
+        ("cache_size", -config["SQLITE_CACHE_SIZE"]),  # negative: KiB, not pages
+        ("temp_store", "MEMORY"),
+    ]
+
+
+PROFILES = {"default": None, "wal": wal_pragmas}
+
+
+def sqlite_file(url):
+    return url.drivername == "sqlite" and url.database not in (None, "", ":memory:")
+
+
+def set_pragmas(engine, pragmas):
+    @event.listens_for(engine, "connect")
+    def connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas:
+            cursor.execute("PRAGMA {} = {}".format(name, value))
+        cursor.close()
+
+
+def replica_allowed():
+    """True if the current request may read from a replica that lags behind."""
+    return request.method in SAFE_METHODS and cookie.get("primary_until", 0) <= time()
+
+
+def read_route():
+    """
+        Where the reads of the current context may go: "replica", "reader", or None for the
+        writer (outside requests). gather() hands the request's route to its threads in g.
+    """
+    if has_request_context():
+        return "replica" if replica_allowed() else "reader"
+    return g.get("read_route") if has_app_context() else None
+
+
+class RoutingSession(SignallingSession):
+    def __init__(self, db, **options):
+        self._router = db
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        bind = super().get_bind(mapper, clause)
+        reader = self._router.readers.get(bind)
+        if reader is None:
+            return bind
+        if self._flushing or isinstance(clause, UpdateBase):
+            self.info["writer"] = True
+        route = read_route()
+        if self.info.get("writer") or route is None:
+            return bind
+        if reader in self._router.replicas and route != "replica":
+            return bind
+        return reader
+
+
+def _after_commit(session):
+    wrote = session.info.pop("writer", None)
+    if wrote and session._router.replicas and has_request_context():
+        # read your writes: the replica may not have this commit yet
+        cookie["primary_until"] = time() + current_app.config["REPLICA_STICKY_SECONDS"]
+
+
+def _after_rollback(session):
+    session.info.pop("writer", None)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """
+        SQLAlchemy with the engine profile of SQLITE_PROFILE applied to file databases, and
+        the reads routed to the reader pool or the replica.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.readers = {}  # writer (or primary) engine -> reader (or replica) engine
+        self.replicas = set()  # the readers that lag behind
+        super().__init__(*args, **kwargs)
+
+    def profile(self, app, sa_url):
+        if not sqlite_file(sa_url):
+            return None
+        name = app.config["SQLITE_PROFILE"]
+        if name not in PROFILES:
+            raise ValueError("unknown SQLITE_PROFILE {!r}".format(name))
+        return PROFILES[name]
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        rv = super().apply_driver_hacks(app, sa_url, options)
+        if self.profile(app, sa_url) is not None:
+            options.update(
+                poolclass=QueuePool,
+                pool_size=1,
+                max_overflow=0,
+                pool_timeout=app.config["SQLITE_BUSY_TIMEOUT"],
+                connect_args={"check_same_thread": False},
+            )
+        return rv
+
+    def create_engine(self, sa_url, engine_opts):
+        engine = super().create_engine(sa_url, engine_opts)
+        app = self.get_app()
+        pragmas = self.profile(app, sa_url)
+        if pragmas is not None:
+            set_pragmas(engine, pragmas(app.config))
+        replica = app.config["SQLALCHEMY_REPLICA_URI"]
+        if replica:
+            self.readers[engine] = self.create_reader(app, make_url(replica))
+            self.replicas.add(self.readers[engine])
+        elif pragmas is not None:
+            self.readers[engine] = self.create_reader(app, sa_url)
+        return engine
+
+    def create_reader(self, app, sa_url):
+        options = {}
+        self.apply_pool_defaults(app, options)
+        self.apply_driver_hacks(app, sa_url, options)
+        options.update(app.config["SQLALCHEMY_ENGINE_OPTIONS"])
+        if options.get("poolclass") is QueuePool:
+            options.update(pool_size=app.config["SQLITE_READERS"], max_overflow=0)
+        reader = create_engine(sa_url, **options)
+        if sqlite_file(sa_url):
+            pragmas = self.profile(app, sa_url)
+            pragmas = pragmas(app.config) if pragmas is not None else []
+            set_pragmas(reader, pragmas + [("query_only", "ON")])
+        return reader
+
+    def create_session(self, options):
+        factory = orm.sessionmaker(class_=RoutingSession, db=self, **options)
+        event.listen(factory, "after_commit", _after_commit)
+        event.listen(factory, "after_rollback", _after_rollback)
+        return factory
+
+
+def copy_sqlite(source_url, target_url, root_path):
+    """
+        Copy a SQLite database over another one, with the online backup API.
+        Relative paths are relative to root_path, like Flask-SQLAlchemy makes them.
+    """
+    source_url, target_url = make_url(source_url), make_url(target_url)
+    if not (sqlite_file(source_url) and sqlite_file(target_url)):
+        raise ValueError("both databases must be SQLite files")
+    source = sqlite3.connect(os.path.join(root_path, source_url.database))
+    target = sqlite3.connect(os.path.join(root_path, target_url.database))
+    try:
+        source.backup(target)
+    finally:
+        target.close()
+        source.close()
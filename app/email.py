@@ -1,8 +1,11 @@
 from flask_mail import Message
-from flask import render_template
+from flask import request
 
 from app import mail, app
-from threading import Thread
+from app.models import reset_password_token
+from threading import Thread, Lock
+from queue import Queue, Empty, Full
+import time
 
 
 # Asynchronous Emails:
@@ -43,24 +46,217 @@ from threading import Thread
 # instance accessible via the current_app variable from Flask.
 
 
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
+# A thread and a new SMTP connection per email does not hold up under a burst of emails though:
+# there is no limit on the number of threads, and every message pays for the SMTP handshake
+# (and TLS and login, with a real server). So emails now go into a bounded queue that a fixed
+# pool of worker threads drains. Each worker keeps its SMTP connection open while there is
+# work, sends up to MAIL_BATCH_SIZE queued messages in a row on it, and closes it after
+# MAIL_IDLE_TIMEOUT seconds without emails. Failed sends are retried with exponential backoff.
+# When the queue is full, send_email() raises MailQueueFull instead of piling up more work.
+
+
+class MailQueueFull(Exception):
+    pass
+
+
+class MailWorkerPool:
+    def __init__(self, workers, maxsize, batch_size, retries, backoff, idle_timeout):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.retries = retries
+        self.backoff = backoff
+        self.idle_timeout = idle_timeout
+        self.queue = Queue(maxsize)
+        self.counters = {
+            "queued": 0,
+            "sent": 0,
+            "failed": 0,
+            "retries": 0,
+            "connections": 0,
+        }
+        self.started = time.monotonic()
+        self._threads = []
+        self._lock = Lock()
+
+    def submit(self, msg, timeout=None):
+        self._start()
+        try:
+            self.queue.put(msg, timeout=timeout)
+        except Full:
+            raise MailQueueFull("outgoing mail queue is full")
+        self._count("queued")
+
+    def metrics(self):
+        elapsed = time.monotonic() - self.started
+        metrics = dict(self.counters)
+        metrics["queue_depth"] = self.queue.qsize()
+        metrics["sent_per_second"] = metrics["sent"] / elapsed if elapsed else 0.0
+        return metrics
+
+    def join(self):
+        """Block until every queued message has been sent or given up on."""
+        self.queue.join()
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def _start(self):
+        with self._lock:
+            while len(self._threads) < self.workers:
+                thread = Thread(target=self._work, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self):
+        with app.app_context():
+            conn = None
+            while True:
+                try:
+                    msg = self.queue.get(timeout=self.idle_timeout if conn else None)
+                except Empty:
+                    conn = self._close(conn)
+                    continue
+                batch = [msg]
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(self.queue.get_nowait())
+                    except Empty:
+                        break
+                for item in batch:
+                    try:
+                        for msg in messages(item):
+                            conn = self._deliver(conn, msg)
+                    except Exception:
+                        app.logger.exception("Could not prepare email %r", item)
+                        self._count("failed")
+                    self.queue.task_done()
+
+    def _deliver(self, conn, msg):
+        for attempt in range(self.retries + 1):
+            try:
+                if conn is None:
+                    conn = mail.connect().__enter__()
+                    self._count("connections")
+                conn.send(msg)
+                self._count("sent")
+                return conn
+            except Exception:
+                conn = self._close(conn)
+                if attempt == self.retries:
+                    app.logger.exception("Could not send email to %s", msg.recipients)
+                    self._count("failed")
+                else:
+                    self._count("retries")
+                    time.sleep(self.backoff * 2 ** attempt)
+        return conn
+
+    def _close(self, conn):
+        if conn is not None:
+            try:
+                conn.__exit__(None, None, None)
+            except Exception:
+                pass  # the connection is already broken
+        return None
+
+
+def messages(item):
+    # queue items are either a ready Message or a TemplateEmail rendered by the worker
+    if isinstance(item, Message):
+        return [item]
+    return item.messages()
+
+
+# Rendering the email templates is done by the mail worker too, so a request only pays for
+# putting a small TemplateEmail in the queue. The templates are compiled once per process,
+# and one TemplateEmail can carry any number of recipients, each with its own template
+# context, which are rendered and sent one after the other on the same SMTP connection.
+_templates = {}
+
+
+def get_template(name):
+    template = _templates.get(name)
+    if template is None:
+        template = _templates[name] = app.jinja_env.get_template(name)
+    return template
+
+
+class TemplateEmail:
+    def __init__(self, subject, sender, template, recipients, base_url):
+        """
+            template is the name of a pair of templates without extension, e.g. "email/reset_password".
+            recipients is an iterable of (email address, template context) pairs.
+            base_url is the request.url_root of the request, so url_for(_external=True) works.
+        """
+        self.subject = subject
+        self.sender = sender
+        self.template = template
+        self.recipients = recipients
+        self.base_url = base_url
+
+    def messages(self):
+        text = get_template(self.template + ".txt")
+        html = get_template(self.template + ".html")
+        with app.test_request_context(base_url=self.base_url):
+            for email, context in self.recipients:
+                msg = Message(self.subject, sender=self.sender, recipients=[email])
+                msg.body = text.render(context)
+                msg.html = html.render(context)
+                yield msg
+
+    def __repr__(self):
+        return "<TemplateEmail {}>".format(self.template)
+
+
+mail_queue = MailWorkerPool(
+    workers=app.config["MAIL_WORKERS"],
+    maxsize=app.config["MAIL_QUEUE_SIZE"],
+    batch_size=app.config["MAIL_BATCH_SIZE"],
+    retries=app.config["MAIL_RETRIES"],
+    backoff=app.config["MAIL_RETRY_BACKOFF"],
+    idle_timeout=app.config["MAIL_IDLE_TIMEOUT"],
+)
 
 
 def send_email(subject, sender, recipients, text_body, html_body):
     msg = Message(subject, sender=sender, recipients=recipients)
     msg.body = text_body
     msg.html = html_body
-    Thread(target=send_async_email, args=(app, msg)).start()
+    mail_queue.submit(msg, timeout=app.config["MAIL_QUEUE_TIMEOUT"])
+
+
+def send_template_email(subject, template, recipients, base_url=None):
+    """Queue one email per (email address, template context) pair in recipients."""
+    mail_queue.submit(
+        TemplateEmail(
+            subject,
+            app.config["ADMINS"][0],
+            template,
+            recipients,
+            base_url or request.url_root,
+        ),
+        timeout=app.config["MAIL_QUEUE_TIMEOUT"],
+    )
+
+
+def password_reset_recipients(users):
+    # only plain values go to the worker thread, ORM objects belong to the request's session.
+    # The tokens are made by the worker, when it iterates over the returned generator.
+    users = [(user.id, user.username, user.email) for user in users]
+    return (
+        (email, {"user": {"username": username}, "token": reset_password_token(id)})
+        for id, username, email in users
+    )
 
 
 def send_password_reset_email(user):
-    token = user.get_reset_password_token()
-    send_email(
+    send_password_reset_emails([user])
+
+
+def send_password_reset_emails(users, base_url=None):
+    send_template_email(
         "[Microblog] Reset Your Password",
-        sender=app.config["ADMINS"][0],
-        recipients=[user.email],
-        text_body=render_template("email/reset_password.txt", user=user, token=token),
-        html_body=render_template("email/reset_password.html", user=user, token=token),
+        "email/reset_password",
+        password_reset_recipients(users),
+        base_url,
     )
@@ -0,0 +1,182 @@
+from collections import Counter, defaultdict
+from functools import wraps
+from threading import Lock
+
+from flask import g, request, session, render_template
+from flask_login import current_user
+from markupsafe import Markup
+
+from app import app, get_locale
+from app.cache import TTLCache, MISSING
+
+
+# Rendered HTML cache.
+# A post looks the same on every timeline page it shows up on, and its body, author and avatar
+# almost never change, so the HTML of _post.html is cached per post, author and locale instead
+# of going through Jinja again for every page view. When an author edits their profile, their
+# "generation" number goes up, which changes the key of all their posts at once.
+#
+# Entries live in an in-process LRU. With FRAGMENT_CACHE_URL set (e.g. redis://localhost:6379/0)
+# a shared cache sits behind it, so all the worker processes benefit from each other's renders.
+# Whole pages can be cached too, with the @cached_page decorator.
+
+
+class RedisBackend:
+    def __init__(self, url, ttl):
+        import redis  # only needed when FRAGMENT_CACHE_URL is set
+
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    def get(self, key, default=MISSING):
+        value = self.client.get(key)
+        return default if value is None else value.decode("utf-8")
+
+    def set(self, key, value, ttl=None):
+        self.client.set(key, value, ex=int(ttl or self.ttl))
+
+    def delete(self, *keys):
+        if keys:
+            self.client.delete(*keys)
+
+    def incr(self, key):
+        return self.client.incr(key)
+
+
+SHARED_BACKENDS = {"redis": RedisBackend}
+
+
+class FragmentCache:
+    def __init__(self, local, shared=None):
+        self.local = local
+        self.shared = shared
+        self._generations = Counter()  # without a shared cache, never expired nor evicted
+        self._lock = Lock()
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is MISSING and self.shared is not None:
+            value = self.shared.get(key)
+            if value is not MISSING:
+                self.local.set(key, value)
+        return value
+
+    def set(self, key, value, ttl=None):
+        self.local.set(key, value, ttl)
+        if self.shared is not None:
+            self.shared.set(key, value, ttl)
+
+    def delete(self, *keys):
+        self.local.delete(*keys)
+        if self.shared is not None:
+            self.shared.delete(*keys)
+
+    # Generations must never go back: an older number would bring back the entries cached under
+    # it. So they are not kept in the local LRU, and the shared ones are INCR'ed keys without TTL.
+    def generation(self, name):
+        if self.shared is not None:
+            return int(self.shared.get("gen:" + name, 0))
+        return self._generations[name]
+
+    def bump(self, name):
+        if self.shared is not None:
+            self.shared.incr("gen:" + name)
+        else:
+            with self._lock:
+                self._generations[name] += 1
+
+
+def make_fragment_cache():
+    ttl = app.config["FRAGMENT_CACHE_TTL"]
+    local = TTLCache(app.config["FRAGMENT_CACHE_SIZE"], ttl)
+    url = app.config["FRAGMENT_CACHE_URL"]
+    shared = SHARED_BACKENDS[url.split(":", 1)[0]](url, ttl) if url else None
+    return FragmentCache(local, shared)
+
+
+fragment_cache = make_fragment_cache()
+
+# hits and misses per endpoint since the process started
+cache_stats = defaultdict(Counter)
+_stats_lock = Lock()
+
+
+def _count(name):
+    counts = g.setdefault("fragment_cache", Counter())
+    counts[name] += 1
+
+
+def cache_stats_snapshot():
+    with _stats_lock:
+        return {endpoint: Counter(counts) for endpoint, counts in cache_stats.items()}
+
+
+def _author_generation(author_id):
+    generations = g.setdefault("author_generations", {})
+    if author_id not in generations:
+        generations[author_id] = fragment_cache.generation("author:{}".format(author_id))
+    return generations[author_id]
+
+
+@app.template_global()
+def render_post(post):
+    """Used by the templates instead of {% include '_post.html' %}."""
+    key = "post:{}:{}:{}:{}".format(
+        post.id, post.user_id, _author_generation(post.user_id), get_locale()
+    )
+    html = fragment_cache.get(key)
+    if html is MISSING:
+        _count("misses")
+        html = render_template("_post.html", post=post)
+        fragment_cache.set(key, html)
+    else:
+        _count("hits")
+    return Markup(html)
+
+
+def invalidate_author(user):
+    fragment_cache.bump("author:{}".format(user.id))
+    g.pop("author_generations", None)
+
+
+def cached_page(f):
+    """
+        Cache the HTML returned by a view for PAGE_CACHE_TTL seconds (0 turns it off).
+        The key has the URL, the user (or "anonymous") and the locale. Responses with
+        flashed messages are neither served from nor stored in the cache.
+    """
+
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        ttl = app.config["PAGE_CACHE_TTL"]
+        if not ttl or request.method != "GET" or "_flashes" in session:
+            return f(*args, **kwargs)
+        user = current_user.id if current_user.is_authenticated else "anonymous"
+        key = "page:{}:{}:{}".format(user, get_locale(), request.full_path)
+        html = fragment_cache.get(key)
+        if html is not MISSING:
+            g.page_cache = "HIT"
+            return html
+        g.page_cache = "MISS"
+        html = f(*args, **kwargs)
+        if isinstance(html, str) and "_flashes" not in session:
+            fragment_cache.set(key, html, ttl)
+        return html
+
+    return wrapper
+
+
+@app.after_request
+def record_cache_stats(response):
+    counts = g.get("fragment_cache", Counter())
+    page = g.get("page_cache")
+    if page:
+        counts["page_" + page.lower()] += 1
+        response.headers["X-Page-Cache"] = page
+    if counts:
+        response.headers["X-Fragment-Cache"] = "hits={}, misses={}".format(
+            counts["hits"], counts["misses"]
+        )
+        with _stats_lock:
+            cache_stats[request.endpoint].update(counts)
+    return response
@@ -0,0 +1,275 @@
+import hmac
+import json
+import logging
+import random
+from collections import Counter, defaultdict
+from threading import Lock
+from time import perf_counter
+
+from flask import g, request, has_app_context, abort
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app import app
+from app.email import mail_queue
+from app.fragments import cache_stats_snapshot
+from app.profiling import request_seconds, phase_seconds
+
+
+# SQL instrumentation.
+# Every statement sent to the database goes through the engine's before/after_cursor_execute
+# events. For the requests picked by SQL_METRICS_SAMPLE_RATE, they are counted and timed in g.sql:
+# number of queries, total time in the database, the slowest statement, and how many times each
+# statement ran. The same statement running SQL_N_PLUS_ONE_THRESHOLD times or more in one request
+# is the sign of an N+1 problem: a query in a loop, usually a lazy loaded relationship.
+#
+# The results of a request go back in a Server-Timing header (shown by the browser developer tools),
+# and into one JSON log line on the "app.sql" logger, at WARNING level for N+1 patterns and queries
+# slower than SLOW_QUERY_MS. They are also added up per endpoint, together with the mail queue and
+# the fragment cache numbers, and served in the Prometheus text format at /metrics. Every worker
+# process has its own totals, so Prometheus must scrape each of them. /metrics is only served with
+# METRICS_TOKEN set, to scrapers sending it as "Authorization: Bearer <METRICS_TOKEN>".
+#
+# Requests that are not sampled only pay for a random() call and a g lookup per statement, so a
+# low sample rate is cheap enough to leave on in production.
+
+logger = logging.getLogger("app.sql")
+
+
+class RequestStats:
+    def __init__(self):
+        self.started = perf_counter()
+        self.queries = 0
+        self.seconds = 0.0
+        self.slowest = (0.0, None)  # seconds, statement
+        self.statements = Counter()
+
+    def record(self, statement, seconds):
+        self.queries += 1
+        self.seconds += seconds
+        self.statements[statement] += 1
+        if seconds > self.slowest[0]:
+            self.slowest = (seconds, statement)
+
+    def merge(self, other):
+        """Add the statements recorded by other, e.g. by a gather() thread."""
+        self.queries += other.queries
+        self.seconds += other.seconds
+        self.statements.update(other.statements)
+        self.slowest = max(self.slowest, other.slowest, key=lambda s: s[0])
+
+    def repeated(self, threshold):
+        """Statements that ran at least `threshold` times, the likely N+1 queries."""
+        return {s: n for s, n in self.statements.items() if n >= threshold}
+
+
+class SQLMetrics:
+    """Totals per endpoint since the process started."""
+
+    def __init__(self):
+        self.totals = defaultdict(Counter)
+        self.slowest = defaultdict(float)
+        self._lock = Lock()
+
+    def add(self, endpoint, stats, n_plus_one):
+        with self._lock:
+            totals = self.totals[endpoint]
+            totals["requests"] += 1
+            totals["queries"] += stats.queries
+            totals["seconds"] += stats.seconds
+            totals["n_plus_one"] += bool(n_plus_one)
+            self.slowest[endpoint] = max(self.slowest[endpoint], stats.slowest[0])
+
+    def snapshot(self):
+        with self._lock:
+            totals = {e: Counter(t) for e, t in self.totals.items()}
+            return totals, dict(self.slowest)
+
+    def clear(self):
+        with self._lock:
+            self.totals.clear()
+            self.slowest.clear()
+
+
+sql_metrics = SQLMetrics()
+
+
+def current_stats():
+    # in a request, or in a gather() thread working for one
+    if has_app_context():
+        return g.get("sql")
+    return None
+
+
+# listening on the Engine class covers every engine the application creates
+@event.listens_for(Engine, "before_cursor_execute")
+def _start_timer(conn, cursor, statement, parameters, context, executemany):
+    if current_stats() is not None:
+        conn.info.setdefault("query_started", []).append(perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _stop_timer(conn, cursor, statement, parameters, context, executemany):
+    stats = current_stats()
+    if stats is not None and conn.info.get("query_started"):
+        stats.record(statement, perf_counter() - conn.info["query_started"].pop())
+
+
+@app.before_request
+def start_sql_metrics():
+    if random.random() < app.config["SQL_METRICS_SAMPLE_RATE"]:
+        g.sql = RequestStats()
+
+
+@app.after_request
+def record_sql_metrics(response):
+    stats = g.pop("sql", None)
+    if stats is None:
+        return response
+    n_plus_one = stats.repeated(app.config["SQL_N_PLUS_ONE_THRESHOLD"])
+    sql_metrics.add(request.endpoint or "unknown", stats, n_plus_one)
+
+    response.headers["Server-Timing"] = ", ".join(
+        [
+            'db;dur={:.2f};desc="{} queries"'.format(
+                stats.seconds * 1000, stats.queries
+            ),
+            "db-slowest;dur={:.2f}".format(stats.slowest[0] * 1000),
+            "app;dur={:.2f}".format((perf_counter() - stats.started) * 1000),
+        ]
+    )
+
+    slow = stats.slowest[0] * 1000 >= app.config["SLOW_QUERY_MS"]
+    logger.log(
+        logging.WARNING if n_plus_one or slow else logging.INFO,
+        json.dumps(
+            {
+                "method": request.method,
+                "path": request.path,
+                "endpoint": request.endpoint,
+                "status": response.status_code,
+                "queries": stats.queries,
+                "db_ms": round(stats.seconds * 1000, 2),
+                "slowest_ms": round(stats.slowest[0] * 1000, 2),
+                "slowest": stats.slowest[1],
+                "n_plus_one": n_plus_one,
+            }
+        ),
+    )
+    return response
+
+
+def prometheus_metric(name, kind, help, samples):
+    """
+    samples: (labels dict, value) pairs, or (name suffix, labels dict, value) for the
+    _bucket, _sum and _count series of a histogram. Returns the lines of one metric family.
+    """
+    lines = ["# HELP {} {}".format(name, help), "# TYPE {} {}".format(name, kind)]
+    for sample in samples:
+        suffix, labels, value = sample if len(sample) == 3 else ("",) + tuple(sample)
+        label_text = ",".join(
+            '{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+            for k, v in sorted(labels.items())
+        )
+        lines.append(
+            "{}{}{} {}".format(
+                name, suffix, "{" + label_text + "}" if label_text else "", value
+            )
+        )
+    return lines
+
+
+MAIL_COUNTERS = {
+    "queued": "Emails put in the outgoing queue.",
+    "sent": "Emails sent by the mail worker pool.",
+    "failed": "Emails given up on after all the retries.",
+    "retries": "Failed sends that were tried again.",
+    "connections": "SMTP connections opened by the mail worker pool.",
+}
+
+
+def collect():
+    totals, slowest = sql_metrics.snapshot()
+
+    def per_endpoint(name):
+        return [({"endpoint": e}, t[name]) for e, t in sorted(totals.items())]
+
+    lines = []
+    lines += prometheus_metric(
+        "microblog_sql_sampled_requests_total",
+        "counter",
+        "Requests whose SQL statements were counted.",
+        per_endpoint("requests"),
+    )
+    lines += prometheus_metric(
+        "microblog_sql_queries_total",
+        "counter",
+        "SQL statements run by the sampled requests.",
+        per_endpoint("queries"),
+    )
+    lines += prometheus_metric(
+        "microblog_sql_seconds_total",
+        "counter",
+        "Time spent in the database by the sampled requests.",
+        per_endpoint("seconds"),
+    )
+    lines += prometheus_metric(
+        "microblog_sql_n_plus_one_requests_total",
+        "counter",
+        "Sampled requests that repeated a statement SQL_N_PLUS_ONE_THRESHOLD times.",
+        per_endpoint("n_plus_one"),
+    )
+    lines += prometheus_metric(
+        "microblog_sql_slowest_query_seconds",
+        "gauge",
+        "Slowest statement seen since the process started.",
+        [({"endpoint": e}, s) for e, s in sorted(slowest.items())],
+    )
+
+    mail = mail_queue.metrics()
+    for name, help in MAIL_COUNTERS.items():
+        lines += prometheus_metric(
+            "microblog_mail_{}_total".format(name), "counter", help, [({}, mail[name])]
+        )
+    lines += prometheus_metric(
+        "microblog_mail_queue_depth",
+        "gauge",
+        "Emails waiting in the outgoing queue.",
+        [({}, mail["queue_depth"])],
+    )
+
+    lines += prometheus_metric(
+        "microblog_fragment_cache_total",
+        "counter",
+        "Rendered HTML cache lookups, by result.",
+        [
+            ({"endpoint": endpoint, "result": result}, n)
+            for endpoint, counts in sorted(cache_stats_snapshot().items(), key=str)
+            for result, n in sorted(counts.items())
+        ],
+    )
+
+    # only filled in when PROFILING_ENABLED is on
+    lines += prometheus_metric(
+        "microblog_request_seconds",
+        "histogram",
+        "Time to handle a request, from before_request to after_request.",
+        request_seconds.samples(("endpoint",)),
+    )
+    lines += prometheus_metric(
+        "microblog_request_phase_seconds",
+        "histogram",
+        "Time of a request spent in each phase, see app/profiling.py.",
+        phase_seconds.samples(("endpoint", "phase")),
+    )
+    return "\n".join(lines) + "\n"
+
+
+@app.route("/metrics")
+def metrics():
+    token = app.config["METRICS_TOKEN"]
+    if not token:
+        abort(404)
+    if not hmac.compare_digest(request.headers.get("Authorization", ""), "Bearer " + token):
+        abort(403)
+    return app.response_class(collect(), mimetype="text/plain; version=0.0.4")
@@ -1,30 +1,190 @@
 from app import db
 from datetime import datetime
-from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
+from sqlalchemy.orm import validates
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.util import identity_key
 from app import login
 from hashlib import md5  # for avatars
+from collections import Counter, namedtuple
 
 from time import time
 import jwt
+from flask import g, has_app_context
 from app import app
+from app.profiling import timed
+from app.passwords import hasher
+from app.cache import TTLCache, MISSING
+from app.fragments import fragment_cache
+
+
+AVATAR_URL = "https://www.gravatar.com/avatar/{}?d=identicon&s={}"
+
+
+def gravatar_hash(email):
+    # expects characters in lower case and in byte form.
+    return md5(email.lower().encode("utf-8")).hexdigest()
 
 
 # Since this is an auxiliary table that has no data other than the foreign keys,
 # I created it without an associated model class.
+# The composite primary key doubles as the index for "who does X follow" (is_following(),
+# followed_posts()), and the reverse index serves "who follows X" (the followers backref).
 followers = db.Table(
     "followers",
-    db.Column("follower_id", db.Integer, db.ForeignKey("user.id")),
-    db.Column("followed_id", db.Integer, db.ForeignKey("user.id")),
+    db.Column("follower_id", db.Integer, db.ForeignKey("user.id"), primary_key=True),
+    db.Column("followed_id", db.Integer, db.ForeignKey("user.id"), primary_key=True),
+    db.Index("ix_followers_followed_id_follower_id", "followed_id", "follower_id"),
+)
+
+# Materialized home timelines, only used when TIMELINE_MODEL is "fanout".
+# Each row means "post_id shows up on the home page of user_id". The rows are written
+# when a post is created (fan-out-on-write) and when a user follows or unfollows someone,
+# so the home page becomes a single range read over (user_id, timestamp) instead of the
+# followers join + UNION + sort that followed_posts() runs in the "pull" model.
+timeline = db.Table(
+    "timeline",
+    db.Column("user_id", db.Integer, db.ForeignKey("user.id"), primary_key=True),
+    db.Column("post_id", db.Integer, db.ForeignKey("post.id"), primary_key=True),
+    db.Column("author_id", db.Integer, db.ForeignKey("user.id")),
+    db.Column("timestamp", db.DateTime),
+    db.Index("ix_timeline_user_id_timestamp", "user_id", "timestamp", "post_id"),
+    db.Index("ix_timeline_user_id_author_id", "user_id", "author_id"),
 )
 
 
+# "Who to follow" suggestions, computed offline by `flask suggestions compute`, see
+# app/suggestions.py. Row rank of user_id suggests following suggested_id, and score is the number
+# of people user_id follows who follow suggested_id. The primary key makes the panel of a user a
+# single range read, already in order.
+suggestions = db.Table(
+    "suggestion",
+    db.Column("user_id", db.Integer, db.ForeignKey("user.id"), primary_key=True),
+    db.Column("rank", db.Integer, primary_key=True, autoincrement=False),
+    db.Column("suggested_id", db.Integer, db.ForeignKey("user.id"), nullable=False),
+    db.Column("score", db.Integer, nullable=False),
+)
+
+
+def fanout_enabled():
+    return app.config["TIMELINE_MODEL"] == "fanout"
+
+
+# Follow-graph cache.
+# is_following() is asked for on every profile page, and it is a query. Answers are memoized in flask.g for the rest of the request and in a TTLCache shared
+# by all requests. follow() and unfollow() mark the keys they change as dirty in the session: dirty
+# keys always go to the database (so uncommitted changes never leak into the shared cache), and
+# they are evicted from the cache once the transaction commits.
+# The cache belongs to one process, so the commit also bumps the "follows:<follower id>" generation
+# of the fragment cache, which is part of the cache keys. With FRAGMENT_CACHE_URL set, the other
+# processes see the bump on their next request; without it, they can answer from their own copy
+# for up to FOLLOW_CACHE_TTL seconds.
+follow_cache = TTLCache(app.config["FOLLOW_CACHE_SIZE"], app.config["FOLLOW_CACHE_TTL"])
+
+
+def _follow_graph_memo():
+    return g.setdefault("follow_graph", {}) if has_app_context() else {}
+
+
+def _follow_generations():
+    return g.setdefault("follow_generations", {}) if has_app_context() else {}
+
+
+def _follow_generation(follower_id):
+    generations = _follow_generations()
+    if follower_id not in generations:
+        generations[follower_id] = fragment_cache.generation("follows:{}".format(follower_id))
+    return generations[follower_id]
+
+
+def cached_follow_graph(key, compute):
+    if None in key or key in db.session.info.get("follow_graph_dirty", ()):
+        return compute()
+    memo = _follow_graph_memo()
+    value = memo.get(key, MISSING)
+    if value is MISSING:
+        shared_key = key + (_follow_generation(key[1]),)
+        value = follow_cache.get(shared_key)
+        if value is MISSING:
+            value = compute()
+            follow_cache.set(shared_key, value)
+    memo[key] = value
+    return value
+
+
+def add_to_counters(session, user_id, **deltas):
+    """
+        Add to the counter columns of a user with a single UPDATE, so concurrent changes do
+        not overwrite each other, and to the loaded User object if there is one.
+    """
+    session.execute(
+        User.__table__.update()
+        .where(User.id == user_id)
+        .values({name: getattr(User, name) + n for name, n in deltas.items()})
+    )
+    user = session.identity_map.get(identity_key(User, user_id))
+    if user is not None:
+        for name, n in deltas.items():
+            if name in user.__dict__:  # loaded, reading it would be a query
+                set_committed_value(user, name, user.__dict__[name] + n)
+
+
+def _follow_graph_changed(follower, followed):
+    # the version of the follower's follow graph, used in the ETag of their pages
+    follower.follows_changed_at = datetime.utcnow()
+    keys = (("is_following", follower.id, followed.id),)
+    db.session.info.setdefault("follow_graph_dirty", set()).update(keys)
+    memo = _follow_graph_memo()
+    for key in keys:
+        memo.pop(key, None)
+
+
+@db.event.listens_for(db.session, "after_commit")
+def _evict_follow_graph(session):
+    keys = session.info.pop("follow_graph_dirty", ())
+    memo = _follow_graph_memo()
+    generations = _follow_generations()
+    follower_ids = {key[1] for key in keys}
+    if follower_ids:
+        # whatever generation they were cached under
+        follow_cache.delete_where(lambda key: key[1] in follower_ids)
+    for follower_id in follower_ids:
+        fragment_cache.bump("follows:{}".format(follower_id))
+        generations.pop(follower_id, None)
+    for key in keys:
+        memo.pop(key, None)
+
+
+@db.event.listens_for(db.session, "after_rollback")
+def _discard_follow_graph(session):
+    # the cache still holds the values from before the rolled back changes, which are right
+    session.info.pop("follow_graph_dirty", None)
+
+
+def reset_password_token(user_id, expires_in=600):
+    # a module function, so the mail worker can make tokens without loading users
+    return jwt.encode(
+        {"reset_password": user_id, "exp": time() + expires_in},
+        app.config["SECRET_KEY"],
+        algorithm="HS256",
+    ).decode("utf-8")
+
+
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(64), index=True, unique=True)
     email = db.Column(db.String(120), index=True, unique=True)
     passowrd_hash = db.Column(db.String(128))
     about_me = db.Column(db.String(140))
+    avatar_hash = db.Column(db.String(32))
+    follows_changed_at = db.Column(db.DateTime)  # last follow() or unfollow()
+    # counters kept up to date by follow(), unfollow() and _count_posts(), so profile pages do not
+    # have to count rows. `flask counters reconcile` repairs them after changes made outside the ORM
+    post_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    follower_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    following_count = db.Column(
+        db.Integer, nullable=False, default=0, server_default="0"
+    )
     last_seen = db.Column(
         db.DateTime, default=datetime.utcnow
     )  # Passing the function, not calling it
@@ -41,47 +201,151 @@ class User(UserMixin, db.Model):
         lazy="dynamic",
     )
 
+    @timed("hashing")
     def set_password(self, password):
-        self.passowrd_hash = generate_password_hash(password)
+        self.passowrd_hash = hasher.hash(password)
 
+    @timed("hashing")
     def check_password(self, password):
-        return check_password_hash(self.passowrd_hash, password)
+        """On success, a hash made with older PASSWORD_HASH_METHOD settings is replaced."""
+        if not hasher.verify(self.passowrd_hash, password):
+            return False
+        if hasher.needs_rehash(self.passowrd_hash):
+            self.set_password(password)
+        return True
+
+    # The gravatar digest is stored with the user and kept in sync with the email, so rendering
+    # an avatar is just string formatting. The migration that added the column filled it for
+    # existing users; rows inserted behind the ORM's back are hashed on the fly.
+    @validates("email")
+    def _update_avatar_hash(self, key, email):
+        self.avatar_hash = gravatar_hash(email) if email is not None else None
+        return email
 
     def avatar(self, size):  # see chapter 6
-        digest = md5(
-            self.email.lower().encode("utf-8")
-        ).hexdigest()  # expects characters in lower case and in byte form.
-        return "https://www.gravatar.com/avatar/{}?d=identicon&s={}".format(
-            digest, size
+        return AVATAR_URL.format(
+            self.avatar_hash or gravatar_hash(self.email), size
         )  # s for size. d is to get default avatar, 'identicon' is the name of avatar
 
     def follow(self, user):
         if not self.is_following(user):
             self.followed.append(user)
+            _follow_graph_changed(self, user)
+            add_to_counters(db.session, self.id, following_count=1)
+            add_to_counters(db.session, user.id, follower_count=1)
+            if fanout_enabled():
+                # copy the posts of the new followed user into my timeline
+                db.session.execute(
+                    timeline.insert().from_select(
+                        ["user_id", "post_id", "author_id", "timestamp"],
+                        db.select(
+                            [db.literal(self.id), Post.id, Post.user_id, Post.timestamp]
+                        ).where(Post.user_id == user.id),
+                    )
+                )
 
     def unfollow(self, user):
         if self.is_following(user):
             self.followed.remove(user)
+            _follow_graph_changed(self, user)
+            add_to_counters(db.session, self.id, following_count=-1)
+            add_to_counters(db.session, user.id, follower_count=-1)
+            if fanout_enabled():
+                db.session.execute(
+                    timeline.delete().where(
+                        db.and_(
+                            timeline.c.user_id == self.id,
+                            timeline.c.author_id == user.id,
+                        )
+                    )
+                )
 
+    # Only needs self.id, so CachedUser can borrow it without loading the user row.
     def is_following(self, user):
-        return self.followed.filter(followers.c.followed_id == user.id).count() > 0
+        def query():
+            edge = db.session.query(followers).filter(
+                followers.c.follower_id == self.id, followers.c.followed_id == user.id
+            )
+            return edge.count() > 0
+
+        return cached_follow_graph(("is_following", self.id, user.id), query)
 
     # Get the posts from the people that I follow.
     # https://blog.miguelgrinberg.com/post/the-flask-mega-tutorial-part-viii-followers
     def followed_posts(self):
+        timestamp, id = self.followed_posts_order()
+        if fanout_enabled():
+            return (
+                Post.query.join(timeline, timeline.c.post_id == Post.id)
+                .filter(timeline.c.user_id == self.id)
+                .options(db.joinedload(Post.author))
+                .order_by(timestamp.desc(), id.desc())
+            )
         followed = Post.query.join(
             followers, (followers.c.followed_id == Post.user_id)
         ).filter(followers.c.follower_id == self.id)
         own = Post.query.filter_by(user_id=self.id)
-        return followed.union(own).order_by(Post.timestamp.desc())
+        return (
+            followed.union(own)
+            .options(db.joinedload(Post.author))
+            .order_by(timestamp.desc(), id.desc())
+        )
+
+    @staticmethod
+    def followed_posts_order():
+        # the (timestamp, id) columns followed_posts() is sorted on, used for keyset pagination
+        if fanout_enabled():
+            return timeline.c.timestamp, timeline.c.post_id
+        return Post.timestamp, Post.id
+
+    def newest_followed_post(self):
+        """The timestamp of the newest post followed_posts() returns, without running it."""
+        if fanout_enabled():
+            return (
+                db.session.query(db.func.max(timeline.c.timestamp))
+                .filter(timeline.c.user_id == self.id)
+                .scalar()
+            )
+        # one MAX() per side of the UNION, each answered by an index
+        followed = (
+            db.session.query(db.func.max(Post.timestamp))
+            .join(followers, followers.c.followed_id == Post.user_id)
+            .filter(followers.c.follower_id == self.id)
+            .scalar()
+        )
+        own = (
+            db.session.query(db.func.max(Post.timestamp))
+            .filter(Post.user_id == self.id)
+            .scalar()
+        )
+        return max((t for t in (followed, own) if t), default=None)
+
+    def suggested_users(self, limit):
+        """
+            [(user, score)] of who to follow. The table is only refreshed by the batch job,
+            so the users followed since then are left out here.
+        """
+        # at most SUGGESTIONS_PER_USER rows, sorted here rather than by the database
+        rows = (
+            db.session.query(User, suggestions.c.score, suggestions.c.rank)
+            .join(suggestions, suggestions.c.suggested_id == User.id)
+            .filter(suggestions.c.user_id == self.id)
+            .filter(
+                ~db.exists().where(
+                    db.and_(
+                        followers.c.follower_id == self.id,
+                        followers.c.followed_id == User.id,
+                    )
+                )
+            )
+            .all()
+        )
+        rows.sort(key=lambda row: row.rank)
+        return [(user, score) for user, score, _ in rows[:limit]]
 
     # functions for password reset
     def get_reset_password_token(self, expires_in=600):
-        return jwt.encode(
-            {"reset_password": self.id, "exp": time() + expires_in},
-            app.config["SECRET_KEY"],
-            algorithm="HS256",
-        ).decode("utf-8")
+        return reset_password_token(self.id, expires_in)
 
     @staticmethod
     def verify_reset_password_token(token):
@@ -109,13 +373,212 @@ class Post(db.Model):
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey("user.id"))
 
+    # serves user.posts.order_by(Post.timestamp.desc()) without scanning the table
+    __table_args__ = (db.Index("ix_post_user_id_timestamp", "user_id", "timestamp"),)
+
+    def fan_out(self):
+        """
+            Push a new post into the timeline of its author and of every follower.
+            Does nothing in the "pull" model, where followed_posts() queries on read.
+        """
+        if not fanout_enabled():
+            return
+        db.session.flush()  # we need self.id
+        db.session.execute(
+            timeline.insert().from_select(
+                ["user_id", "post_id", "author_id", "timestamp"],
+                db.select(
+                    [
+                        followers.c.follower_id,
+                        db.literal(self.id),
+                        db.literal(self.user_id),
+                        db.literal(self.timestamp),
+                    ]
+                )
+                .where(followers.c.followed_id == self.user_id)
+                .union_all(
+                    db.select(
+                        [
+                            db.literal(self.user_id),
+                            db.literal(self.id),
+                            db.literal(self.user_id),
+                            db.literal(self.timestamp),
+                        ]
+                    )
+                ),
+            )
+        )
+
     def __repr__(self):
         return "<Post {}>".format(self.body)
 
 
+def rebuild_timelines():
+    """
+        Rebuild the whole timeline table from followers and post.
+        Used to backfill existing data when switching TIMELINE_MODEL to "fanout".
+    """
+    db.session.execute(timeline.delete())
+    followed = db.select(
+        [followers.c.follower_id, Post.id, Post.user_id, Post.timestamp]
+    ).where(followers.c.followed_id == Post.user_id)
+    own = db.select(
+        [Post.user_id.label("owner_id"), Post.id, Post.user_id, Post.timestamp]
+    )
+    db.session.execute(
+        timeline.insert().from_select(
+            ["user_id", "post_id", "author_id", "timestamp"], followed.union(own)
+        )
+    )
+    db.session.commit()
+    return db.session.execute(
+        db.select([db.func.count()]).select_from(timeline)
+    ).scalar()
+
+
+@db.event.listens_for(db.session, "after_flush")
+def _count_posts(session, flush_context):
+    # session.new and session.deleted still hold what this flush wrote
+    changes = Counter()
+    for obj in session.new:
+        if isinstance(obj, Post):
+            changes[obj.user_id] += 1
+    for obj in session.deleted:
+        if isinstance(obj, Post):
+            changes[obj.user_id] -= 1
+    for user_id, n in changes.items():
+        if user_id is not None and n:
+            add_to_counters(session, user_id, post_count=n)
+
+
+def reconcile_counters():
+    """
+        Recount the posts and follows of every user in one UPDATE, and fix the counters
+        that drifted. Returns the number of users that were fixed.
+    """
+    counts = {
+        "post_count": db.select([db.func.count()]).where(Post.user_id == User.id),
+        "follower_count": db.select([db.func.count()]).where(
+            followers.c.followed_id == User.id
+        ),
+        "following_count": db.select([db.func.count()]).where(
+            followers.c.follower_id == User.id
+        ),
+    }
+    counts = {name: query.as_scalar() for name, query in counts.items()}
+    result = db.session.execute(
+        User.__table__.update()
+        .where(db.or_(*(getattr(User, name) != count for name, count in counts.items())))
+        .values(counts)
+    )
+    db.session.commit()
+    return result.rowcount
+
+
 # Because Flask-Login knows nothing about databases, it needs the application's help in loading a user.
 # For that reason, the extension expects that the application will configure a user loader function,
 # that can be called to load a user given the ID.
+#
+# Loading the user is the first query of every authenticated request, so load_user() returns a
+# CachedUser: a proxy over a read-only snapshot of the columns the templates and decorators use,
+# kept in a TTLCache shared by all requests. Anything else (setting an attribute, follow(), the
+# email...) loads the User row, once per request. Snapshots are evicted when a transaction that
+# changed their user commits, e.g. in edit_profile, a follow or a password reset. Like the follow
+# graph cache, the key has a "user:<id>" generation bumped by that commit, so with
+# FRAGMENT_CACHE_URL set the other processes stop using their snapshot too.
+SNAPSHOT_FIELDS = (
+    "id",
+    "username",
+    "avatar_hash",
+    "about_me",
+    "last_seen",
+    "follows_changed_at",
+)
+UserSnapshot = namedtuple("UserSnapshot", SNAPSHOT_FIELDS)
+
+session_users = TTLCache(
+    app.config["SESSION_USER_CACHE_SIZE"], app.config["SESSION_USER_CACHE_TTL"]
+)
+
+
+def _session_user_key(user_id):
+    return user_id, fragment_cache.generation("user:{}".format(user_id))
+
+
+class CachedUser(UserMixin):
+    def __init__(self, key, snapshot, user=None):
+        object.__setattr__(self, "_key", key)
+        object.__setattr__(self, "_snapshot", snapshot)
+        object.__setattr__(self, "_user", user)
+
+    @property
+    def user(self):
+        """The User row, loaded on first use."""
+        if self._user is None:
+            object.__setattr__(self, "_user", User.query.get(self._snapshot.id))
+        return self._user
+
+    def __getattr__(self, name):
+        if name in SNAPSHOT_FIELDS and self._user is None:
+            return getattr(self._snapshot, name)
+        return getattr(self.user, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.user, name, value)
+
+    def set_last_seen(self, now):
+        # see LastSeenTracker.touch, the row is updated in the background. The next requests
+        # load the same snapshot, so it gets the new time too.
+        snapshot = self._snapshot._replace(last_seen=now)
+        session_users.replace(self._key, self._snapshot, snapshot)
+        object.__setattr__(self, "_snapshot", snapshot)
+        if self._user is not None:
+            set_committed_value(self._user, "last_seen", now)
+
+    avatar = User.avatar
+    is_following = User.is_following
+    followed_posts = User.followed_posts
+    followed_posts_order = staticmethod(User.followed_posts_order)
+    newest_followed_post = User.newest_followed_post
+    suggested_users = User.suggested_users
+
+    def __repr__(self):
+        return "<CachedUser {}>".format(self.username)
+
+
 @login.user_loader
 def load_user(id):
-    return User.query.get(int(id))
+    key = _session_user_key(int(id))
+    snapshot = session_users.get(key)
+    if snapshot is not MISSING:
+        return CachedUser(key, snapshot)
+    user = User.query.get(int(id))
+    if user is None:
+        return None
+    snapshot = UserSnapshot(*(getattr(user, field) for field in SNAPSHOT_FIELDS))
+    session_users.set(key, snapshot)
+    return CachedUser(key, snapshot, user)
+
+
+@db.event.listens_for(db.session, "before_flush")
+def _mark_changed_users(session, flush_context, instances):
+    changed = session.info.setdefault("changed_users", set())
+    changed.update(
+        obj.id
+        for obj in session.dirty | session.deleted
+        if isinstance(obj, User) and obj.id is not None
+    )
+
+
+@db.event.listens_for(db.session, "after_commit")
+def _evict_session_users(session):
+    changed = session.info.pop("changed_users", ())
+    if changed:
+        session_users.delete_where(lambda key: key[0] in changed)
+    for user_id in changed:
+        fragment_cache.bump("user:{}".format(user_id))
+
+
+@db.event.listens_for(db.session, "after_rollback")
+def _discard_changed_users(session):
+    session.info.pop("changed_users", None)
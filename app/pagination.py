@@ -0,0 +1,98 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime
+
+from app import db
+
+
+# Keyset (a.k.a. cursor) pagination.
+# paginate() from Flask-SQLAlchemy uses LIMIT/OFFSET and runs an extra COUNT(*) to know how many
+# pages there are. Both get slower the deeper the user scrolls, because the database still has to
+# walk over all the skipped rows. Instead, every link carries the (timestamp, id) of the last post
+# that was shown, and the next page simply asks for the posts "older than that one". With an index
+# on the sort columns this costs the same on page 1000 as on page 1, and no COUNT is needed.
+
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+
+def encode_cursor(timestamp, id):
+    raw = "{}|{}".format(timestamp.strftime(TIMESTAMP_FORMAT), id)
+    return urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(token):
+    # raises ValueError on bad input, so it can be used as the type= of request.args.get()
+    try:
+        raw = urlsafe_b64decode(token + "=" * (-len(token) % 4)).decode("utf-8")
+        timestamp, id = raw.split("|")
+        return datetime.strptime(timestamp, TIMESTAMP_FORMAT), int(id)
+    except (TypeError, UnicodeDecodeError, ValueError) as e:
+        raise ValueError("invalid cursor") from e
+
+
+class KeysetPage:
+    def __init__(self, items, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor  # pass as ?before= to get older posts
+        self.prev_cursor = prev_cursor  # pass as ?after= to get newer posts
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+
+def newest_first(query, order_by, before=None):
+    """query sorted newest first, starting right after the before cursor if there is one."""
+    timestamp_col, id_col = order_by
+    if before is not None:
+        query = query.filter(db.tuple_(timestamp_col, id_col) < before)
+    return query.order_by(None).order_by(timestamp_col.desc(), id_col.desc())
+
+
+def paginate_keyset(query, order_by, per_page, before=None, after=None):
+    """
+        Return a KeysetPage of query, newest first.
+        order_by is the (timestamp, id) column pair the query is sorted on, before/after are
+        decoded cursors. One row more than needed is fetched to know if there is another page.
+    """
+    timestamp_col, id_col = order_by
+    query = query.order_by(None)
+    if after is not None:
+        # walk towards newer posts, page_from_rows() flips them back to newest first
+        rows = (
+            query.filter(db.tuple_(timestamp_col, id_col) > after)
+            .order_by(timestamp_col.asc(), id_col.asc())
+            .limit(per_page + 1)
+            .all()
+        )
+    else:
+        rows = newest_first(query, order_by, before).limit(per_page + 1).all()
+    return page_from_rows(rows, per_page, before, after)
+
+
+def page_from_rows(rows, per_page, before=None, after=None):
+    """
+        Build the KeysetPage from the per_page + 1 rows next to the cursor: newest first,
+        or oldest first when walking towards newer posts with an after cursor.
+    """
+    has_more = len(rows) > per_page
+    if after is not None:
+        items = rows[:per_page][::-1]
+        has_older = True
+        has_newer = has_more
+    else:
+        items = rows[:per_page]
+        has_older = has_more
+        has_newer = before is not None
+
+    if not items:
+        return KeysetPage(items)
+    first, last = items[0], items[-1]
+    return KeysetPage(
+        items,
+        next_cursor=encode_cursor(last.timestamp, last.id) if has_older else None,
+        prev_cursor=encode_cursor(first.timestamp, first.id) if has_newer else None,
+    )
@@ -0,0 +1,72 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+from flask import g
+
+from app import app, db
+from app.database import read_route
+from app.instrumentation import RequestStats, current_stats
+from app.profiling import timed
+
+
+# Independent queries at the same time.
+# A page like /user/<username> asks the database several questions that do not depend on each
+# other (the newest post, the two follow counts, is_following). Run one after another, their
+# round trips add up; gather() sends them from a pool of QUERY_WORKERS threads instead, so the page
+# waits about as long as the slowest one. This pays off with a database server over the network.
+# SQLite answers from the same process in microseconds, and the thread hand-off would cost more
+# than it saves, so QUERY_WORKERS defaults to 0 there, which runs the functions in order.
+#
+# Every function runs in its own app context, so with its own database session. ORM objects it
+# returns are detached from it: pass them through adopt() before lazy loading anything from them.
+# The functions cannot use the request context (request, current_user, g of the request), but the
+# request's database routing goes with them (they read from the readers or the replica when the
+# request would), and their statements are added to the request's SQL metrics. The request thread
+# waits for them in the "db" phase.
+
+_executors = {}  # QUERY_WORKERS -> ThreadPoolExecutor
+_lock = Lock()
+
+
+def _executor(workers):
+    with _lock:
+        if workers not in _executors:
+            _executors[workers] = ThreadPoolExecutor(
+                workers, thread_name_prefix="query"
+            )
+        return _executors[workers]
+
+
+def _in_app_context(f, read_route, sampled):
+    with app.app_context():
+        g.read_route = read_route
+        if sampled:
+            g.sql = RequestStats()
+        return f(), g.get("sql")
+
+
+@timed("db")
+def _results(futures):
+    return [future.result() for future in futures]
+
+
+def gather(*functions):
+    """Call the functions concurrently and return their results, in order."""
+    workers = app.config["QUERY_WORKERS"]
+    if not workers or len(functions) < 2:
+        return [f() for f in functions]
+    route, stats = read_route(), current_stats()
+    futures = [
+        _executor(workers).submit(_in_app_context, f, route, stats is not None)
+        for f in functions
+    ]
+    results = _results(futures)
+    if stats is not None:
+        for _, worker_stats in results:
+            stats.merge(worker_stats)
+    return [result for result, _ in results]
+
+
+def adopt(instances):
+    """Attach ORM objects loaded by gather() to the session of the request."""
+    return [db.session.merge(instance, load=False) for instance in instances]
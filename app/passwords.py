@@ -0,0 +1,99 @@
+import atexit
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from threading import BoundedSemaphore, Lock
+
+from werkzeug.security import (
+    DEFAULT_PBKDF2_ITERATIONS,
+    check_password_hash,
+    generate_password_hash,
+)
+
+from app import app
+
+
+# Password hashing.
+# Hashing is slow on purpose, and with threads it holds the GIL (werkzeug's pbkdf2 does), so a burst
+# of logins would stall every other request of the process. With PASSWORD_HASH_WORKERS set, the
+# hashes are computed by a pool of that many processes instead (the default, 0, hashes in the
+# request thread, which is what scripts and the CLI want), and at most
+# PASSWORD_HASH_QUEUE_SIZE passwords wait for it: past that, PasswordHasherBusy is raised after
+# PASSWORD_HASH_QUEUE_TIMEOUT seconds rather than letting requests pile up.
+#
+# The algorithm and work factor come from PASSWORD_HASH_METHOD and PASSWORD_SALT_LENGTH, in
+# werkzeug's format. Existing hashes keep working when they change: a hash made with other settings
+# is replaced with a new one the next time its user logs in.
+
+
+class PasswordHasherBusy(Exception):
+    pass
+
+
+def normalize_method(method):
+    """The method as werkzeug writes it in the hash, e.g. pbkdf2:sha256 -> pbkdf2:sha256:150000."""
+    parts = method.split(":")
+    if parts[0] == "pbkdf2" and len(parts) == 2:
+        parts.append(str(DEFAULT_PBKDF2_ITERATIONS))
+    return ":".join(parts)
+
+
+class PasswordHasher:
+    def __init__(self, workers, queue_size, timeout):
+        self.workers = workers
+        self.timeout = timeout
+        self._slots = BoundedSemaphore(queue_size)
+        self._executor = None
+        self._lock = Lock()
+
+    def hash(self, password):
+        return self._run(
+            generate_password_hash,
+            password,
+            app.config["PASSWORD_HASH_METHOD"],
+            app.config["PASSWORD_SALT_LENGTH"],
+        )
+
+    def verify(self, pwhash, password):
+        return self._run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        if pwhash.count("$") < 2:
+            return True
+        method, salt, _ = pwhash.split("$", 2)
+        return (
+            method != normalize_method(app.config["PASSWORD_HASH_METHOD"])
+            or len(salt) != app.config["PASSWORD_SALT_LENGTH"]
+        )
+
+    def _run(self, func, *args):
+        if not self.workers:
+            return func(*args)
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PasswordHasherBusy("too many passwords waiting to be hashed")
+        try:
+            return self._pool().submit(func, *args).result()
+        finally:
+            self._slots.release()
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                # spawned, not forked: a fork would copy the locks held by the other threads
+                self._executor = ProcessPoolExecutor(
+                    self.workers, mp_context=multiprocessing.get_context("spawn")
+                )
+            return self._executor
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+
+hasher = PasswordHasher(
+    app.config["PASSWORD_HASH_WORKERS"],
+    app.config["PASSWORD_HASH_QUEUE_SIZE"],
+    app.config["PASSWORD_HASH_QUEUE_TIMEOUT"],
+)
+atexit.register(hasher.shutdown)
@@ -0,0 +1,394 @@
+import cProfile
+import hmac
+import os
+import re
+import sys
+from collections import Counter
+from datetime import datetime
+from functools import wraps
+from itertools import count
+from threading import Event, Lock, Thread, get_ident
+from time import perf_counter
+
+from flask import (
+    abort,
+    before_render_template,
+    flash,
+    g,
+    has_request_context,
+    jsonify,
+    redirect,
+    render_template,
+    request,
+    send_from_directory,
+    template_rendered,
+    url_for,
+)
+from flask_login import current_user, login_required
+from flask_wtf import FlaskForm
+from wtforms import IntegerField, SelectField, StringField, SubmitField
+from wtforms.validators import DataRequired, NumberRange
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app import app
+
+
+# Opt-in profiling, turned on with PROFILING_ENABLED.
+#
+# Phases: the time of every request is split between the database, Jinja templates, WTForms
+# validation, password hashing, locale selection, and "other" (the view code itself). Functions
+# are charged to a phase with the @timed decorator (templates through Flask's rendering signals,
+# forms by the views calling validate_on_submit() and validate() below), and time always goes to
+# the innermost phase, so a lazy load query run by a template counts as db and not as template. The durations go into
+# per-endpoint histograms on /metrics, and into the Server-Timing header of the response.
+#
+# Captures: a single request can be profiled either with cProfile (every call, slow but exact) or
+# with a sampler thread that records the stack of the request thread every PROFILE_SAMPLE_INTERVAL
+# seconds (cheap, for production). A capture is triggered by sending
+#     X-Profile: cprofile (or sample)
+#     X-Profile-Token: <PROFILING_TOKEN>
+# or by an admin (an email in ADMINS) arming the next requests on the /admin/profile page. Dumps are
+# written to PROFILE_DIR: .prof files are pstats files (python -m pstats, snakeviz), .collapsed files
+# are folded stacks (speedscope, flamegraph.pl).
+
+PHASES = ("db", "template", "forms", "hashing", "locale", "other")
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class PhaseTimer:
+    def __init__(self):
+        self.started = perf_counter()
+        self.totals = Counter()
+        self._stack = []  # [phase, time it last became the innermost phase]
+
+    def enter(self, phase):
+        now = perf_counter()
+        if self._stack:
+            outer = self._stack[-1]
+            self.totals[outer[0]] += now - outer[1]
+        self._stack.append([phase, now])
+
+    def exit(self):
+        now = perf_counter()
+        phase, started = self._stack.pop()
+        self.totals[phase] += now - started
+        if self._stack:
+            self._stack[-1][1] = now
+
+    def finish(self):
+        total = perf_counter() - self.started
+        phases = {phase: self.totals[phase] for phase in PHASES}
+        phases["other"] = max(total - sum(self.totals.values()), 0.0)
+        return total, phases
+
+
+def current_timer():
+    if has_request_context():
+        return g.get("phases")
+    return None
+
+
+def timed(phase):
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            timer = current_timer()
+            if timer is None:
+                return f(*args, **kwargs)
+            timer.enter(phase)
+            try:
+                return f(*args, **kwargs)
+            finally:
+                timer.exit()
+
+        return wrapper
+
+    return decorator
+
+
+@before_render_template.connect_via(app)
+def _enter_template(sender, template, context, **extra):
+    timer = current_timer()
+    if timer is not None:
+        timer.enter("template")
+
+
+@template_rendered.connect_via(app)
+def _exit_template(sender, template, context, **extra):
+    timer = current_timer()
+    if timer is not None:
+        timer.exit()
+
+
+@timed("forms")
+def validate_on_submit(form):
+    return form.validate_on_submit()
+
+
+@timed("forms")
+def validate(form):
+    return form.validate()
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _enter_db(conn, cursor, statement, parameters, context, executemany):
+    timer = current_timer()
+    if timer is not None:
+        timer.enter("db")
+        conn.info["phase_timer"] = timer
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _exit_db(conn, cursor, statement, parameters, context, executemany):
+    timer = conn.info.pop("phase_timer", None)
+    if timer is not None:
+        timer.exit()
+
+
+@event.listens_for(Engine, "handle_error")
+def _exit_db_on_error(context):
+    timer = context.connection.info.pop("phase_timer", None)
+    if timer is not None:
+        timer.exit()
+
+
+class Histograms:
+    """Prometheus style histograms (cumulative bucket counts, sum and count) keyed by labels."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self._data = {}  # labels tuple -> [count per bucket..., sum, count]
+        self._lock = Lock()
+
+    def observe(self, labels, value):
+        with self._lock:
+            data = self._data.setdefault(labels, [0] * (len(self.buckets) + 2))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data[i] += 1
+            data[-2] += value
+            data[-1] += 1
+
+    def samples(self, label_names):
+        with self._lock:
+            data = {labels: list(values) for labels, values in self._data.items()}
+        for labels, values in sorted(data.items(), key=str):
+            labels = dict(zip(label_names, labels))
+            for bound, n in zip(self.buckets, values):
+                yield "_bucket", dict(labels, le=str(bound)), n
+            yield "_bucket", dict(labels, le="+Inf"), values[-1]
+            yield "_sum", labels, values[-2]
+            yield "_count", labels, values[-1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+request_seconds = Histograms(BUCKETS)
+phase_seconds = Histograms(BUCKETS)
+
+
+@app.before_request
+def start_phase_timer():
+    if app.config["PROFILING_ENABLED"]:
+        g.phases = PhaseTimer()
+
+
+@app.after_request
+def record_phases(response):
+    timer = g.pop("phases", None)
+    if timer is None:
+        return response
+    endpoint = request.endpoint or "unknown"
+    total, phases = timer.finish()
+    request_seconds.observe((endpoint,), total)
+    for phase, seconds in phases.items():
+        phase_seconds.observe((endpoint, phase), seconds)
+    existing = response.headers.get("Server-Timing")
+    timings = ", ".join(
+        "{};dur={:.2f}".format(phase, seconds * 1000)
+        for phase, seconds in phases.items()
+        # db is already there when the SQL instrumentation sampled the request
+        if seconds and not (phase == "db" and existing)
+    )
+    response.headers["Server-Timing"] = (
+        "{}, {}".format(existing, timings) if existing else timings
+    )
+    return response
+
+
+class CProfileCapture:
+    extension = "prof"
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+
+    def dump(self, path):
+        self.profile.dump_stats(path)
+
+
+class SamplingCapture:
+    extension = "collapsed"
+
+    def __init__(self):
+        self.interval = app.config["PROFILE_SAMPLE_INTERVAL"]
+        self.stacks = Counter()
+        self._stopped = Event()
+
+    def start(self):
+        self._target = get_ident()
+        self._thread = Thread(target=self._sample, daemon=True)
+        self._thread.start()
+
+    def _sample(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self._target)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(
+                    "{}:{}".format(os.path.basename(code.co_filename), code.co_name)
+                )
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def dump(self, path):
+        with open(path, "w") as f:
+            for stack, n in self.stacks.most_common():
+                f.write("{} {}\n".format(stack, n))
+
+
+CAPTURES = {"cprofile": CProfileCapture, "sample": SamplingCapture}
+
+
+class ProfilerMiddleware:
+    """Wraps app.wsgi_app, so a capture covers the whole request including the streamed body."""
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+        self.armed = []  # {"mode", "path", "remaining"}, set up with POST /admin/profile
+        self._lock = Lock()
+        self._numbers = count(1)
+
+    def arm(self, mode, path, remaining):
+        with self._lock:
+            self.armed.append({"mode": mode, "path": path, "remaining": remaining})
+
+    def requested_mode(self, environ):
+        token = app.config["PROFILING_TOKEN"]
+        mode = environ.get("HTTP_X_PROFILE")
+        if mode in CAPTURES and token:
+            if hmac.compare_digest(environ.get("HTTP_X_PROFILE_TOKEN", ""), token):
+                return mode
+        with self._lock:
+            for armed in self.armed:
+                if environ.get("PATH_INFO", "").startswith(armed["path"]):
+                    armed["remaining"] -= 1
+                    if not armed["remaining"]:
+                        self.armed.remove(armed)
+                    return armed["mode"]
+        return None
+
+    def __call__(self, environ, start_response):
+        if not app.config["PROFILING_ENABLED"]:
+            return self.wsgi_app(environ, start_response)
+        mode = self.requested_mode(environ)
+        if mode is None:
+            return self.wsgi_app(environ, start_response)
+
+        capture = CAPTURES[mode]()
+        name = "{:%Y%m%d-%H%M%S}-{}-{}{}.{}".format(
+            datetime.utcnow(),
+            os.getpid(),
+            next(self._numbers),
+            re.sub(r"[^A-Za-z0-9]+", "-", environ.get("PATH_INFO", "")).rstrip("-"),
+            capture.extension,
+        )
+
+        def start_profiled_response(status, headers, exc_info=None):
+            headers.append(("X-Profile-Dump", name))
+            return start_response(status, headers, exc_info)
+
+        capture.start()
+        try:
+            iterable = self.wsgi_app(environ, start_profiled_response)
+            try:
+                # a streamed response does most of its work while it is iterated
+                body = list(iterable)
+            finally:
+                if hasattr(iterable, "close"):
+                    iterable.close()
+        finally:
+            capture.stop()
+        os.makedirs(app.config["PROFILE_DIR"], exist_ok=True)
+        capture.dump(os.path.join(app.config["PROFILE_DIR"], name))
+        return body
+
+
+profiler = ProfilerMiddleware(app.wsgi_app)
+app.wsgi_app = profiler
+
+
+def admin_required(f):
+    @wraps(f)
+    @login_required
+    def wrapper(*args, **kwargs):
+        if not app.config["PROFILING_ENABLED"]:
+            abort(404)
+        if current_user.email not in app.config["ADMINS"]:
+            abort(403)
+        return f(*args, **kwargs)
+
+    return wrapper
+
+
+class ArmProfilerForm(FlaskForm):
+    mode = SelectField(
+        "Profiler",
+        choices=[("cprofile", "cProfile (every call)"), ("sample", "Sampling")],
+    )
+    path = StringField("Path starts with", default="/", validators=[DataRequired()])
+    count = IntegerField("Requests", default=1, validators=[NumberRange(min=1)])
+    submit = SubmitField("Profile")
+
+
+@app.route("/admin/profile", methods=["GET", "POST"])
+@admin_required
+def arm_profiler():
+    """Profile the next count requests whose path starts with path."""
+    form = ArmProfilerForm()
+    if validate_on_submit(form):
+        profiler.arm(form.mode.data, form.path.data, form.count.data)
+        flash(
+            "Profiling the next {} requests whose path starts with {}".format(
+                form.count.data, form.path.data
+            )
+        )
+        return redirect(url_for("arm_profiler"))
+    return render_template("profile.html", title="Profiling", form=form)
+
+
+@app.route("/admin/profiles")
+@admin_required
+def list_profiles():
+    directory = app.config["PROFILE_DIR"]
+    names = sorted(os.listdir(directory)) if os.path.isdir(directory) else []
+    return jsonify(profiles=names)
+
+
+@app.route("/admin/profiles/<name>")
+@admin_required
+def download_profile(name):
+    return send_from_directory(app.config["PROFILE_DIR"], name, as_attachment=True)
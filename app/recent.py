@@ -0,0 +1,270 @@
+import sys
+from bisect import bisect_left, bisect_right
+from threading import Lock, Thread
+from time import monotonic
+
+from app import app, db
+from app.models import User, Post, AVATAR_URL, gravatar_hash
+from app.pagination import page_from_rows
+
+
+# Newest posts in memory.
+# The explore page is the same global feed for everyone, and nearly all its views are of the first
+# few pages. Each worker process keeps the newest RECENT_POSTS_SIZE posts, authors included, in a
+# list sorted by (timestamp, id), and serves those pages from it without a query. Pages older than
+# the buffer still go to the database. The buffer is filled on the first request, gets the posts
+# made by this process as they are created, and is also capped at about RECENT_POSTS_MAX_BYTES.
+#
+# Posts created by other processes are picked up with a query for the ids above the newest one
+# read from the database, at most every RECENT_POSTS_SYNC_INTERVAL seconds. The posts added by this
+# process do not count: another process may have committed a lower id in the meantime. Everything
+# is reloaded every RECENT_POSTS_REFRESH_INTERVAL seconds (which also brings in the new usernames
+# of other processes' users). With RECENT_POSTS_NOTIFY_URL (e.g. redis://localhost:6379/0) processes tell each other
+# about new posts and profile changes over Redis pub/sub, and catch up on the next request.
+
+
+class RecentAuthor:
+    __slots__ = ("id", "username", "avatar_hash")
+
+    def __init__(self, id, username, avatar_hash):
+        self.id = id
+        self.username = username
+        self.avatar_hash = avatar_hash
+
+    def avatar(self, size):
+        return AVATAR_URL.format(self.avatar_hash, size)
+
+
+class RecentPost:
+    """What _post.html needs of a post, detached from any database session."""
+
+    __slots__ = ("id", "body", "timestamp", "user_id", "author")
+
+    def __init__(self, id, body, timestamp, author):
+        self.id = id
+        self.body = body
+        self.timestamp = timestamp
+        self.user_id = author.id
+        self.author = author
+
+    @property
+    def key(self):
+        return self.timestamp, self.id
+
+    @property
+    def size(self):
+        # the post object, its body and its list slots, authors are shared between posts
+        return sys.getsizeof(self) + sys.getsizeof(self.body or "") + 100
+
+
+class RedisNotifier:
+    channel = "microblog:recent-posts"
+
+    def __init__(self, url, on_message):
+        import redis  # only needed when RECENT_POSTS_NOTIFY_URL is set
+
+        self.client = redis.Redis.from_url(url)
+        self.on_message = on_message
+        self._thread = None
+
+    def publish(self, message):
+        self.client.publish(self.channel, message)
+
+    def listen(self):
+        if self._thread is None:
+            self._thread = Thread(target=self._listen, daemon=True)
+            self._thread.start()
+
+    def _listen(self):
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(self.channel)
+        for message in pubsub.listen():
+            self.on_message(message["data"].decode("utf-8"))
+
+
+NOTIFIERS = {"redis": RedisNotifier}
+
+
+class RecentPosts:
+    def __init__(self, maxlen, max_bytes, sync_interval, refresh_interval, notify_url):
+        self.maxlen = maxlen
+        self.max_bytes = max_bytes
+        self.sync_interval = sync_interval
+        self.refresh_interval = refresh_interval
+        self.notifier = (
+            NOTIFIERS[notify_url.split(":", 1)[0]](notify_url, self._notified)
+            if notify_url
+            else None
+        )
+        self._lock = Lock()
+        self._sync_lock = Lock()
+        self.clear()
+
+    @property
+    def enabled(self):
+        return self.maxlen > 0
+
+    def clear(self):
+        """Forget everything, the next request loads the buffer again."""
+        with self._lock:
+            self._posts = []  # oldest first
+            self._keys = []  # (timestamp, id) of the posts, for bisect
+            self._authors = {}
+            self._bytes = 0
+            self.complete = False  # True when no post older than the buffer exists
+            self.synced_id = 0  # the newest post id read from the database
+            self._loaded_at = None
+            self._synced_at = None
+
+    def _rows(self, *criteria):
+        query = (
+            db.session.query(
+                Post.id,
+                Post.body,
+                Post.timestamp,
+                User.id,
+                User.username,
+                User.avatar_hash,
+                User.email,
+            )
+            .join(User, User.id == Post.user_id)
+            .filter(*criteria)
+            .order_by(Post.timestamp.desc(), Post.id.desc())
+            .limit(self.maxlen)
+        )
+        posts = []
+        for id, body, timestamp, user_id, username, avatar_hash, email in query:
+            author = RecentAuthor(
+                user_id, username, avatar_hash or gravatar_hash(email or "")
+            )
+            posts.append(RecentPost(id, body, timestamp, author))
+        return posts
+
+    def _insert(self, post):
+        # called with self._lock held
+        author = self._authors.setdefault(post.author.id, post.author)
+        post.author = author
+        index = bisect_left(self._keys, post.key)
+        if index < len(self._keys) and self._keys[index] == post.key:
+            return
+        if index == 0 and self._posts and not self.complete:
+            return  # older than the buffer, there may be posts in between
+        self._posts.insert(index, post)
+        self._keys.insert(index, post.key)
+        self._bytes += post.size
+        while len(self._posts) > self.maxlen or (
+            self._bytes > self.max_bytes and len(self._posts) > 1
+        ):
+            self._bytes -= self._posts.pop(0).size
+            del self._keys[0]
+            self.complete = False
+
+    def warm(self):
+        """Load the newest posts from the database."""
+        if not self.enabled:
+            return
+        posts = self._rows()
+        with self._lock:
+            self._posts, self._keys, self._authors, self._bytes = [], [], {}, 0
+            self.synced_id = max((post.id for post in posts), default=0)
+            self.complete = True
+            for post in reversed(posts):
+                self._insert(post)
+            if len(posts) >= self.maxlen:
+                self.complete = False
+            self._loaded_at = self._synced_at = monotonic()
+        if self.notifier is not None:
+            self.notifier.listen()
+
+    def sync(self):
+        """Catch up with the posts created by other processes, if it is time to."""
+        now = monotonic()
+        if self._loaded_at is not None and (
+            now - self._synced_at < self.sync_interval
+        ):
+            return
+        # one thread syncs, the others serve what is already there
+        if not self._sync_lock.acquire(blocking=self._loaded_at is None):
+            return
+        try:
+            if self._loaded_at is None or now - self._loaded_at >= self.refresh_interval:
+                self.warm()
+                return
+            posts = self._rows(Post.id > self.synced_id)
+            with self._lock:
+                for post in posts:
+                    self._insert(post)
+                    self.synced_id = max(self.synced_id, post.id)
+                self._synced_at = now
+        finally:
+            self._sync_lock.release()
+
+    def add(self, post, author):
+        """Add a post just committed by this process. author has id, username, avatar_hash, email."""
+        if not self.enabled or self._loaded_at is None:
+            return  # the post will be there when the buffer is loaded
+        recent = RecentPost(
+            post.id,
+            post.body,
+            post.timestamp,
+            RecentAuthor(
+                author.id, author.username, author.avatar_hash or gravatar_hash(author.email)
+            ),
+        )
+        with self._lock:
+            self._insert(recent)
+        if self.notifier is not None:
+            self.notifier.publish("post")
+
+    def update_author(self, user):
+        """After a profile change, so the buffer shows the new username."""
+        with self._lock:
+            author = self._authors.get(user.id)
+            if author is not None:
+                author.username = user.username
+                author.avatar_hash = user.avatar_hash or gravatar_hash(user.email)
+        if self.notifier is not None:
+            self.notifier.publish("author")
+
+    def _notified(self, message):
+        if message == "author":
+            self._loaded_at = None  # reload everything on the next request
+        self._synced_at = None if self._loaded_at is None else 0
+
+    def newest(self):
+        """The time of the newest post, or None without posts."""
+        self.sync()
+        with self._lock:
+            return self._keys[-1][0] if self._keys else None
+
+    def page(self, per_page, before=None, after=None):
+        """A KeysetPage like paginate_keyset() would return, or None if the buffer cannot tell."""
+        if not self.enabled:
+            return None
+        self.sync()
+        with self._lock:
+            if after is not None:
+                if not self.complete and (not self._keys or after < self._keys[0]):
+                    return None
+                start = bisect_right(self._keys, after)
+                rows = self._posts[start : start + per_page + 1]
+            else:
+                end = len(self._keys) if before is None else bisect_left(self._keys, before)
+                if end < per_page + 1 and not self.complete:
+                    return None
+                rows = self._posts[max(end - per_page - 1, 0) : end][::-1]
+        return page_from_rows(rows, per_page, before, after)
+
+
+recent_posts = RecentPosts(
+    app.config["RECENT_POSTS_SIZE"],
+    app.config["RECENT_POSTS_MAX_BYTES"],
+    app.config["RECENT_POSTS_SYNC_INTERVAL"],
+    app.config["RECENT_POSTS_REFRESH_INTERVAL"],
+    app.config["RECENT_POSTS_NOTIFY_URL"],
+)
+
+
+@app.before_first_request
+def warm_recent_posts():
+    recent_posts.sync()
@@ -1,11 +1,10 @@
-from flask import render_template, flash, redirect
+from flask import render_template, flash, redirect, g
 from flask import url_for
 from flask import request
 from flask_login import current_user, login_user
 from flask_login import logout_user, login_required
 
 from werkzeug.urls import url_parse
-from datetime import datetime
 
 from app.models import User, Post
 from app import app, db
@@ -16,13 +15,40 @@ from app.forms import (
     PostForm,
     ResetPasswordRequestForm,
     ResetPasswordForm,
+    SearchForm,
 )
-from app.email import send_password_reset_email
+from app.email import send_password_reset_email, MailQueueFull
+from app.passwords import PasswordHasherBusy
+from app.pagination import paginate_keyset, decode_cursor
+from app.activity import last_seen
+from app.search import add_to_index, query_index
+from app.fragments import cached_page, invalidate_author
+from app.conditional import conditional, csrf_period
+from app.parallel import gather, adopt
+from app.profiling import validate, validate_on_submit
+from app.recent import recent_posts
+
+
+def who_to_follow():
+    """The suggestions panel of the current user, [(user, score)], looked up once per request."""
+    if "who_to_follow" not in g:
+        g.who_to_follow = current_user.suggested_users(app.config["SUGGESTIONS_SHOWN"])
+    return g.who_to_follow
+
+
+def who_to_follow_shown():
+    # what the panel shows, for the ETag
+    return tuple((user.id, user.username, score) for user, score in who_to_follow())
+
+
+def index_validator():
+    return current_user.newest_followed_post(), (csrf_period(), who_to_follow_shown())
 
 
 @app.route("/", methods=["GET", "POST"])
 @app.route("/index", methods=["GET", "POST"])
 @login_required
+@conditional(index_validator)
 def index():
     user = {"username": "Miguel"}  # Not used after the introduction of database
     # Not used after the introduction of database
@@ -46,41 +72,65 @@ def index():
     #  refreshes the page after submitting a web form.
 
     form = PostForm()
-    if form.validate_on_submit():
-        post = Post(body=form.post.data, author=current_user)
+    if validate_on_submit(form):
+        post = Post(body=form.post.data, user_id=current_user.id)
         db.session.add(post)
+        post.fan_out()
+        add_to_index(post)
         db.session.commit()
+        recent_posts.add(post, current_user)
         flash("Your post is now live!")
         return redirect(url_for("index"))
 
-    page = request.args.get("page", 1, type=int)
-    posts = current_user.followed_posts().paginate(
-        page, app.config["POSTS_PER_PAGE"], False
+    posts = paginate_keyset(
+        current_user.followed_posts(),
+        current_user.followed_posts_order(),
+        app.config["POSTS_PER_PAGE"],
+        before=request.args.get("before", type=decode_cursor),
+        after=request.args.get("after", type=decode_cursor),
     )
 
-    next_url = url_for("index", page=posts.next_num) if posts.has_next else None
-    prev_url = url_for("index", page=posts.prev_num) if posts.has_prev else None
+    next_url = url_for("index", before=posts.next_cursor) if posts.has_next else None
+    prev_url = url_for("index", after=posts.prev_cursor) if posts.has_prev else None
 
     return render_template(
         "index.html",
         title="Home",
         posts=posts.items,
         form=form,
+        suggestions=who_to_follow(),
         next_url=next_url,
         prev_url=prev_url,
     )
 
 
+def explore_validator():
+    if recent_posts.enabled:
+        return recent_posts.newest(), ()
+    return db.session.query(db.func.max(Post.timestamp)).scalar(), ()
+
+
 @app.route("/explore")
 @login_required
+@conditional(explore_validator)
+@cached_page
 def explore():
-    page = request.args.get("page", 1, type=int)
-    posts = Post.query.order_by(Post.timestamp.desc()).paginate(
-        page, app.config["POSTS_PER_PAGE"], False
-    )
-
-    next_url = url_for("explore", page=posts.next_num) if posts.has_next else None
-    prev_url = url_for("explore", page=posts.prev_num) if posts.has_prev else None
+    before = request.args.get("before", type=decode_cursor)
+    after = request.args.get("after", type=decode_cursor)
+    posts = recent_posts.page(app.config["POSTS_PER_PAGE"], before, after)
+    if posts is None:
+        # older than the newest posts kept in memory
+        # _post.html shows the author of every post, so load them in the same query
+        posts = paginate_keyset(
+            Post.query.options(db.joinedload(Post.author)),
+            (Post.timestamp, Post.id),
+            app.config["POSTS_PER_PAGE"],
+            before=before,
+            after=after,
+        )
+
+    next_url = url_for("explore", before=posts.next_cursor) if posts.has_next else None
+    prev_url = url_for("explore", after=posts.prev_cursor) if posts.has_prev else None
 
     return render_template(
         "index.html",
@@ -91,17 +141,34 @@ def explore():
     )
 
 
+@app.route("/search")
+@login_required
+def search():
+    if not validate(g.search_form):
+        return redirect(url_for("explore"))
+    q = g.search_form.q.data
+    page = request.args.get("page", 1, type=int)
+    posts, has_next = query_index(q, page, app.config["POSTS_PER_PAGE"])
+    next_url = url_for("search", q=q, page=page + 1) if has_next else None
+    prev_url = url_for("search", q=q, page=page - 1) if page > 1 else None
+    return render_template(
+        "search.html", title="Search", posts=posts, next_url=next_url, prev_url=prev_url
+    )
+
+
 @app.route("/login", methods=["GET", "POST"])
 def login():
     if current_user.is_authenticated:
         return redirect(url_for("index"))
 
     form = LoginForm()
-    if form.validate_on_submit():
+    if validate_on_submit(form):
         user = User.query.filter_by(username=form.username.data).first()
         if user is None or not user.check_password(form.password.data):
             flash("Invalid username or password")
             return redirect(url_for("login"))
+        if db.session.is_modified(user):  # the password hash was upgraded
+            db.session.commit()
         login_user(user, remember=form.remember_me.data)
         next_page = request.args.get(
             "next"
@@ -137,7 +204,7 @@ def register():
     if current_user.is_authenticated:
         return redirect(url_for("index"))
     form = RegistrationForm()
-    if form.validate_on_submit():
+    if validate_on_submit(form):
         user = User(username=form.username.data, email=form.email.data)
         user.set_password(form.password.data)
         db.session.add(user)
@@ -149,49 +216,106 @@ def register():
     return render_template("register.html", title="Register", form=form)
 
 
+def viewer_follows(user):
+    """For gather(), which cannot use current_user."""
+    viewer = current_user._get_current_object()
+    return lambda: viewer.is_following(user)
+
+
+def profile_user(username):
+    """The user of a profile page, looked up once per request."""
+    if "profile_user" not in g:
+        g.profile_user = User.query.filter_by(username=username).first_or_404()
+    return g.profile_user
+
+
+def user_validator(username):
+    user = profile_user(username)
+    newest, following = gather(
+        lambda: db.session.query(db.func.max(Post.timestamp))
+        .filter(Post.user_id == user.id)
+        .scalar(),
+        viewer_follows(user),
+    )
+    changes = [c for c in (newest, user.last_seen) if c]
+    return (
+        max(changes, default=None),
+        (
+            user.id,
+            # every post on the page shows the avatar of its author
+            user.avatar_hash,
+            user.about_me,
+            user.post_count,
+            user.follower_count,
+            user.following_count,
+            following,
+            # the panel is only on your own page
+            who_to_follow_shown() if user.id == current_user.id else (),
+        ),
+    )
+
+
 @app.route("/user/<username>")
 @login_required
+@conditional(user_validator)
 def user(username):  # argument is extracted from link variable
     # below if user found, it will return first user
     # otherwise it will raise error 404 by itself, we don't need to do that explicitly.
-    user = User.query.filter_by(username=username).first_or_404()
-
-    page = request.args.get("page", 1, type=int)
-    # From backref in User Model
-    posts = user.posts.order_by(Post.timestamp.desc()).paginate(
-        page, app.config["POSTS_PER_PAGE"], False
+    user = profile_user(username)
+
+    # the posts and is_following do not depend on each other, see app/parallel.py
+    before = request.args.get("before", type=decode_cursor)
+    after = request.args.get("after", type=decode_cursor)
+    posts, following = gather(
+        lambda: paginate_keyset(
+            Post.query.filter_by(user_id=user.id).options(db.joinedload(Post.author)),
+            (Post.timestamp, Post.id),
+            app.config["POSTS_PER_PAGE"],
+            before=before,
+            after=after,
+        ),
+        viewer_follows(user),
     )
+    posts.items = adopt(posts.items)
     next_url = (
-        url_for("user", username=user.username, page=posts.next_num)
+        url_for("user", username=user.username, before=posts.next_cursor)
         if posts.has_next
         else None
     )
     prev_url = (
-        url_for("user", username=user.username, page=posts.prev_num)
+        url_for("user", username=user.username, after=posts.prev_cursor)
         if posts.has_prev
         else None
     )
     return render_template(
-        "user.html", user=user, posts=posts.items, next_url=next_url, prev_url=prev_url
+        "user.html",
+        user=user,
+        posts=posts.items,
+        following=following,
+        suggestions=who_to_follow() if user.id == current_user.id else [],
+        next_url=next_url,
+        prev_url=prev_url,
     )
 
 
 @app.before_request
 def before_request():
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow()
-        # db.session.add(current_user)
-        db.session.commit()
+        # recorded in memory and written in bulk by a background thread, see app/activity.py
+        last_seen.touch(current_user._get_current_object())
+        g.search_form = SearchForm()
 
 
 @app.route("/edit_profile", methods=["GET", "POST"])
 @login_required
 def edit_profile():
     form = EditProfileForm()
-    if form.validate_on_submit():
+    if validate_on_submit(form):
         current_user.username = form.username.data
         current_user.about_me = form.about_me.data
         db.session.commit()
+        invalidate_author(current_user)  # their posts show the old username
+        recent_posts.update_author(current_user)
         flash("Your changes have been saved.")
         return redirect(url_for("edit_profile"))
     elif request.method == "GET":
@@ -206,10 +330,16 @@ def reset_password_request():
         return redirect(url_for("index"))
 
     form = ResetPasswordRequestForm()
-    if form.validate_on_submit():
+    if validate_on_submit(form):
         user = User.query.filter_by(email=form.email.data).first()
         if user:
-            send_password_reset_email(user)
+            try:
+                send_password_reset_email(user)
+            except MailQueueFull:
+                flash(
+                    "We are sending a lot of emails right now, please try again later"
+                )
+                return redirect(url_for("reset_password_request"))
         flash("Check your email for the instructions to reset your password")
         return redirect(url_for("login"))
 
@@ -226,7 +356,7 @@ def reset_password(token):
     if not user:
         return redirect(url_for("index"))
     form = ResetPasswordForm()
-    if form.validate_on_submit():
+    if validate_on_submit(form):
         user.set_password(form.password.data)
         db.session.commit()
         flash("Your password has been updated.")
@@ -234,6 +364,13 @@ def reset_password(token):
     return render_template("reset_password.html", form=form)
 
 
+@app.errorhandler(PasswordHasherBusy)
+def password_hasher_busy(e):
+    # a storm of logins, the form can be sent again in a moment
+    flash("We are handling a lot of sign ins right now, please try again")
+    return redirect(request.url)
+
+
 """ --------------- Follower Routes ---------------- """
 
 
@@ -0,0 +1,128 @@
+from sqlalchemy import DDL, text
+
+from app import app, db
+from app.models import Post
+
+
+# Full-text search over Post.body.
+# The rest of the application only uses add_to_index(), remove_from_index(), query_index() and
+# reindex(), which hand the work to the backend selected with the SEARCH_BACKEND config variable.
+# Adding support for another database (or an external search server) means writing a new backend
+# class with the same methods and registering it in BACKENDS.
+
+
+class LikeBackend:
+    """Works anywhere, but scans every post. Results are simply the newest matches first."""
+
+    def add(self, post):
+        pass
+
+    def remove(self, post):
+        pass
+
+    def reindex(self):
+        pass
+
+    def query(self, terms, offset, limit):
+        query = Post.query.with_entities(Post.id)
+        for term in terms:
+            query = query.filter(
+                Post.body.ilike("%{}%".format(escape_like(term)), "\\")
+            )
+        rows = query.order_by(Post.timestamp.desc()).offset(offset).limit(limit)
+        return [id for id, in rows]
+
+
+class SQLiteFTSBackend:
+    """
+        An FTS5 index stored in the post_fts virtual table, ranked with bm25.
+        It is an external content table, so the post text is not stored twice.
+    """
+
+    def add(self, post):
+        db.session.execute(
+            text("INSERT INTO post_fts (rowid, body) VALUES (:id, :body)"),
+            {"id": post.id, "body": post.body},
+        )
+
+    def remove(self, post):
+        # external content tables need the old values to remove them from the index
+        db.session.execute(
+            text(
+                "INSERT INTO post_fts (post_fts, rowid, body) "
+                "VALUES ('delete', :id, :body)"
+            ),
+            {"id": post.id, "body": post.body},
+        )
+
+    def reindex(self):
+        # reads every post again, e.g. after posts were bulk loaded behind the ORM's back
+        db.session.execute(text("INSERT INTO post_fts (post_fts) VALUES ('rebuild')"))
+
+    def query(self, terms, offset, limit):
+        # every term is quoted, so FTS5 operators typed by the user are searched as text
+        match = " ".join('"{}"'.format(term.replace('"', '""')) for term in terms)
+        rows = db.session.execute(
+            text(
+                "SELECT rowid FROM post_fts WHERE post_fts MATCH :match "
+                "ORDER BY rank LIMIT :limit OFFSET :offset"
+            ),
+            {"match": match, "limit": limit, "offset": offset},
+        )
+        return [id for id, in rows]
+
+
+BACKENDS = {"like": LikeBackend, "sqlite": SQLiteFTSBackend}
+
+# The index table follows the post table around, so db.create_all() and migrations both get it.
+db.event.listen(
+    Post.__table__,
+    "after_create",
+    DDL(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS post_fts "
+        "USING fts5(body, content='post', content_rowid='id')"
+    ).execute_if(dialect="sqlite"),
+)
+db.event.listen(
+    Post.__table__,
+    "before_drop",
+    DDL("DROP TABLE IF EXISTS post_fts").execute_if(dialect="sqlite"),
+)
+
+
+def escape_like(term):
+    return term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def backend():
+    return BACKENDS[app.config["SEARCH_BACKEND"]]()
+
+
+def add_to_index(post):
+    db.session.flush()  # the index needs post.id
+    backend().add(post)
+
+
+def remove_from_index(post):
+    backend().remove(post)
+
+
+def reindex():
+    backend().reindex()
+    db.session.commit()
+
+
+def query_index(q, page, per_page):
+    """
+        Return the posts matching every word of q, best first, and whether there are more.
+        One extra id is asked for to know if there is a next page, instead of counting all matches.
+    """
+    terms = q.split()
+    if not terms:
+        return [], False
+    ids = backend().query(terms, (page - 1) * per_page, per_page + 1)
+    has_next = len(ids) > per_page
+    ids = ids[:per_page]
+    posts = Post.query.options(db.joinedload(Post.author)).filter(Post.id.in_(ids))
+    by_id = {post.id: post for post in posts}
+    return [by_id[id] for id in ids if id in by_id], has_next
@@ -0,0 +1,976 @@
+"""
+Database benchmarks for microblog.
+
+Each benchmark builds its own SQLite database in a temporary directory, so app.db is never touched.
+
+    python benchmarks.py indexes --users 100000 --follows 100 --posts 10
+
+The routes benchmark logs in simulated users and sends them around the site, then reports the
+latency percentiles, SQL queries per request and throughput of every page. Save the report of two
+commits with --json and compare them:
+
+    python benchmarks.py --json before.json routes --users 10000 --server --clients 8
+    python benchmarks.py compare before.json after.json
+
+Run with --help for the options of every benchmark.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import random
+import statistics
+import subprocess
+import tempfile
+import time
+import timeit
+import urllib.error
+import urllib.parse
+import urllib.request
+from threading import Lock, Thread
+
+from flask import g, has_request_context
+
+from alembic.migration import MigrationContext
+from alembic.operations import Operations
+from alembic.script import ScriptDirectory
+from flask_migrate import upgrade
+from sqlalchemy import event
+from werkzeug.security import generate_password_hash
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+from app import app, db
+from app.models import (
+    User,
+    Post,
+    AVATAR_URL,
+    gravatar_hash,
+    rebuild_timelines,
+    reconcile_counters,
+    follow_cache,
+    followers,
+    session_users,
+)
+from app.activity import last_seen
+from app.pagination import encode_cursor, paginate_keyset
+from app.passwords import PasswordHasher
+from app.recent import recent_posts
+from app.search import query_index
+
+MIGRATIONS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+
+
+def use_database(path, revision="head"):
+    """Point the application at a new SQLite file and migrate it to revision."""
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + path
+    with app.app_context():
+        upgrade(directory=MIGRATIONS, revision=revision)
+
+
+def run_migration(revision, direction):
+    """Run the upgrade() or downgrade() of a single migration on the current database."""
+    module = ScriptDirectory(MIGRATIONS).get_revision(revision).module
+    with db.engine.begin() as conn:
+        with Operations.context(MigrationContext.configure(conn)):
+            getattr(module, direction)()
+
+
+def seed(
+    users, follows, posts, vocabulary=None, distribution="uniform", batch_size=100000
+):
+    """
+    Insert users, follow edges and posts with executemany on the raw DBAPI connection.
+    Every user writes `posts` posts. With the "uniform" distribution every user follows
+    `follows` distinct random users. With "powerlaw", the number of follows per user is
+    Pareto distributed with `follows` as the mean, and the chance of being followed falls
+    as 1/rank, so a few users have a huge audience, like on a real social network.
+    With a vocabulary, post bodies are random words from it with a Zipf-like frequency.
+    """
+    conn = db.engine.raw_connection()
+    cursor = conn.cursor()
+    started = time.perf_counter()
+
+    def insert(sql, rows):
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                cursor.executemany(sql, batch)
+                batch = []
+        if batch:
+            cursor.executemany(sql, batch)
+
+    insert(
+        "INSERT INTO user (id, username, email) VALUES (?, ?, ?)",
+        (
+            (i, "user{}".format(i), "user{}@example.com".format(i))
+            for i in range(1, users + 1)
+        ),
+    )
+
+    population = range(1, users + 1)
+    popularity = list(itertools.accumulate(1 / rank for rank in population))
+
+    def followed_by(follower):
+        if distribution == "powerlaw":
+            # the mean of paretovariate(1.5) is 3
+            k = min(int(random.paretovariate(1.5) * follows / 3), users - 1)
+            return set(random.choices(population, cum_weights=popularity, k=k))
+        return random.sample(population, min(follows, users))
+
+    def edges():
+        for follower in population:
+            for followed in followed_by(follower):
+                if followed != follower:
+                    yield follower, followed
+
+    insert("INSERT INTO followers (follower_id, followed_id) VALUES (?, ?)", edges())
+
+    if vocabulary:
+        weights = list(
+            itertools.accumulate(1 / rank for rank in range(1, len(vocabulary) + 1))
+        )
+
+        def body(n, i):
+            return " ".join(random.choices(vocabulary, cum_weights=weights, k=10))
+
+    else:
+
+        def body(n, i):
+            return "post {} from user{}".format(n, i)
+
+    start = time.time() - posts * users
+    insert(
+        "INSERT INTO post (body, timestamp, user_id) VALUES (?, ?, ?)",
+        (
+            (body(n, i), _timestamp(start + n * users + i), i)
+            for n in range(posts)
+            for i in range(1, users + 1)
+        ),
+    )
+    conn.commit()
+    conn.close()
+    return time.perf_counter() - started
+
+
+def _timestamp(seconds):
+    return time.strftime("%Y-%m-%d %H:%M:%S.000000", time.gmtime(seconds))
+
+
+class StatementRecorder:
+    """Collect the statements sent to the engine, to show their query plans afterwards."""
+
+    def __init__(self):
+        self.statements = []
+
+    def __enter__(self):
+        event.listen(db.engine, "before_cursor_execute", self.record)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(db.engine, "before_cursor_execute", self.record)
+
+    def record(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append((statement, parameters))
+
+
+def query_plans(statements):
+    plans = []
+    conn = db.engine.raw_connection()
+    for statement, parameters in statements:
+        rows = conn.execute("EXPLAIN QUERY PLAN " + statement, parameters).fetchall()
+        plans.append(
+            {"sql": " ".join(statement.split()), "plan": [r[-1] for r in rows]}
+        )
+    conn.close()
+    return plans
+
+
+def follow_graph_operations(per_page):
+    # each operation takes two users and runs the queries of one page view
+    return {
+        # the query behind is_following(), which would otherwise be answered by the follow cache
+        "is_following": lambda u, v: db.session.query(followers)
+        .filter(followers.c.follower_id == u.id, followers.c.followed_id == v.id)
+        .count()
+        > 0,
+        "followers_count": lambda u, v: v.followers.count(),
+        "followed_count": lambda u, v: u.followed.count(),
+        "followed_posts_page": lambda u, v: paginate_keyset(
+            u.followed_posts(), u.followed_posts_order(), per_page
+        ).items,
+        "user_posts_page": lambda u, v: paginate_keyset(
+            v.posts, (Post.timestamp, Post.id), per_page
+        ).items,
+    }
+
+
+def measure(operations, users, samples):
+    results = {}
+    pairs = [
+        (random.randint(1, users), random.randint(1, users)) for _ in range(samples)
+    ]
+    loaded = {
+        u.id: u for u in User.query.filter(User.id.in_({i for p in pairs for i in p}))
+    }
+    for name, operation in operations.items():
+        with StatementRecorder() as recorder:
+            operation(loaded[pairs[0][0]], loaded[pairs[0][1]])
+        timings = []
+        for u, v in pairs:
+            started = time.perf_counter()
+            operation(loaded[u], loaded[v])
+            timings.append((time.perf_counter() - started) * 1000)
+        results[name] = {
+            "median_ms": statistics.median(timings),
+            "max_ms": max(timings),
+            "plans": query_plans(recorder.statements),
+        }
+    return results
+
+
+def bench_indexes(args):
+    """Follower/author lookups before and after the follower and author indexes migration."""
+    report = {"parameters": vars(args).copy(), "runs": {}}
+    report["parameters"].pop("func")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        # the current schema, without the indexes of b7e3f0a2c915 until the "after" run
+        use_database(path)
+        run_migration("b7e3f0a2c915", "downgrade")
+        print("Seeding {} users...".format(args.users))
+        report["seed_seconds"] = seed(args.users, args.follows, args.posts)
+        operations = follow_graph_operations(app.config["POSTS_PER_PAGE"])
+        for label in ("before", "after"):
+            if label == "after":
+                db.session.remove()
+                started = time.perf_counter()
+                run_migration("b7e3f0a2c915", "upgrade")
+                report["migration_seconds"] = time.perf_counter() - started
+            report["runs"][label] = measure(operations, args.users, args.samples)
+        db.session.remove()
+
+    for name in operations:
+        before, after = report["runs"]["before"][name], report["runs"]["after"][name]
+        print(
+            "\n{}: {:.3f} ms -> {:.3f} ms (median)".format(
+                name, before["median_ms"], after["median_ms"]
+            )
+        )
+        for label, run in (("before", before), ("after", after)):
+            for plan in run["plans"]:
+                print("  {:6} {}".format(label, " | ".join(plan["plan"])))
+    return report
+
+
+def bench_avatar(args):
+    """User.avatar() with the stored digest against hashing the email on every call."""
+    user = User(username="john", email="John.Doe@Example.com")
+
+    def hashing(size):
+        return AVATAR_URL.format(gravatar_hash(user.email), size)
+
+    assert hashing(36) == user.avatar(36)
+    report = {"parameters": {"calls": args.calls}}
+    for name, func in (("hash_per_call", hashing), ("stored_digest", user.avatar)):
+        seconds = min(timeit.repeat(lambda: func(36), number=args.calls, repeat=5))
+        report[name] = {"ns_per_call": seconds / args.calls * 1e9}
+        print("{:14} {:8.1f} ns per call".format(name, report[name]["ns_per_call"]))
+    return report
+
+
+def bench_passwords(args):
+    """Password checks per second, hashed in the request threads or in a process pool."""
+    report = {"parameters": {k: v for k, v in vars(args).items() if k != "func"}}
+    print(
+        "{:24} {:>8} {:>12} {:>14}".format("method", "workers", "logins/s", "per core")
+    )
+    for method in args.methods:
+        app.config["PASSWORD_HASH_METHOD"] = method
+        report[method] = {}
+        for workers in args.workers:
+            hasher = PasswordHasher(workers, args.threads, timeout=None)
+            pwhash = hasher.hash("cat")  # also starts the pool
+            remaining = itertools.count(args.logins, -1)
+
+            def login():
+                while next(remaining) > 0:
+                    assert hasher.verify(pwhash, "cat")
+
+            threads = [Thread(target=login) for _ in range(args.threads)]
+            started = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - started
+            hasher.shutdown()
+
+            # in the request threads, hashing holds the GIL and uses one core at most
+            cores = min(workers, os.cpu_count()) if workers else 1
+            result = report[method][workers] = {
+                "logins_per_second": args.logins / elapsed,
+                "logins_per_second_per_core": args.logins / elapsed / cores,
+            }
+            print(
+                "{:24} {:8d} {:12.1f} {:14.1f}".format(
+                    method,
+                    workers,
+                    result["logins_per_second"],
+                    result["logins_per_second_per_core"],
+                )
+            )
+    return report
+
+
+def bench_suggestions(args):
+    """Time the who to follow job on a generated follower graph."""
+    from app.suggestions import compute_suggestions  # needs numpy and scipy
+
+    report = {"parameters": {k: v for k, v in vars(args).items() if k != "func"}}
+    with tempfile.TemporaryDirectory() as tmp:
+        use_database(os.path.join(tmp, "bench.db"))
+        print(
+            "Seeding {} users with {} follows each...".format(args.users, args.follows)
+        )
+        seed(args.users, args.follows, 0, distribution=args.distribution)
+        for run in range(args.runs):
+            result = report[run] = compute_suggestions(args.k, args.block_size)
+            print(
+                "{:,} edges: load {:.2f}s, compute {:.2f}s, write {:.2f}s, "
+                "total {:.2f}s, {:,} suggestions".format(
+                    result["edges"],
+                    result["load_seconds"],
+                    result["compute_seconds"],
+                    result["write_seconds"],
+                    result["total_seconds"],
+                    result["suggestions"],
+                )
+            )
+        db.session.remove()
+    return report
+
+
+def bench_search(args):
+    """Full-text search with the FTS5 index against a LIKE scan of every post."""
+    report = {"parameters": {"posts": args.posts, "samples": args.samples}}
+    vocabulary = ["word{}".format(i) for i in range(args.words)]
+    with tempfile.TemporaryDirectory() as tmp:
+        use_database(os.path.join(tmp, "bench.db"))
+        print("Seeding {} posts...".format(args.posts))
+        per_user = 100
+        report["seed_seconds"] = seed(
+            max(args.posts // per_user, 1), 0, per_user, vocabulary=vocabulary
+        )
+        started = time.perf_counter()
+        db.engine.execute("INSERT INTO post_fts (post_fts) VALUES ('rebuild')")
+        report["index_seconds"] = time.perf_counter() - started
+
+        # one and two word queries, with common words (many matches) and rare ones
+        buckets = {
+            "common": vocabulary[:20],
+            "rare": vocabulary[len(vocabulary) // 2 :],
+        }
+        for backend in ("sqlite", "like"):
+            app.config["SEARCH_BACKEND"] = backend
+            report[backend] = {}
+            for bucket, words in buckets.items():
+                timings = []
+                for n in range(args.samples):
+                    q = " ".join(random.sample(words, 1 + n % 2))
+                    started = time.perf_counter()
+                    query_index(q, 1, app.config["POSTS_PER_PAGE"])
+                    timings.append((time.perf_counter() - started) * 1000)
+                report[backend][bucket] = {
+                    "median_ms": statistics.median(timings),
+                    "max_ms": max(timings),
+                }
+                print(
+                    "{:6} {:6} words: median {:9.3f} ms, max {:9.3f} ms".format(
+                        backend,
+                        bucket,
+                        report[backend][bucket]["median_ms"],
+                        report[backend][bucket]["max_ms"],
+                    )
+                )
+            db.session.remove()
+    return report
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[int(round(q * (len(values) - 1)))]
+
+
+def summarize(timings, queries, elapsed):
+    return {
+        "requests": len(timings),
+        "p50_ms": percentile(timings, 0.50),
+        "p95_ms": percentile(timings, 0.95),
+        "p99_ms": percentile(timings, 0.99),
+        "mean_queries": statistics.mean(queries),
+        "requests_per_second": len(timings) / elapsed if elapsed else 0.0,
+    }
+
+
+class QueryCounter:
+    """Counts the statements of each request, sent back in the X-Bench-Queries header."""
+
+    def install(self):
+        event.listen(db.engine, "before_cursor_execute", self.record)
+        app.after_request(self.header)
+
+    def record(self, conn, cursor, statement, parameters, context, executemany):
+        if has_request_context():
+            g.bench_queries = g.get("bench_queries", 0) + 1
+
+    def header(self, response):
+        response.headers["X-Bench-Queries"] = str(g.get("bench_queries", 0))
+        return response
+
+
+class TestClientDriver:
+    """Calls the application in-process, through the Flask test client."""
+
+    def __init__(self):
+        self.client = app.test_client()
+
+    def request(self, method, url, data=None):
+        response = self.client.open(url, method=method, data=data)
+        return response.status_code, response.headers
+
+    def close(self):
+        pass
+
+
+class HTTPDriver:
+    """Sends real HTTP requests to the application served by a local WSGI server."""
+
+    server = None
+
+    def __init__(self):
+        if HTTPDriver.server is None:
+            HTTPDriver.server = make_server(
+                "127.0.0.1", 0, app, threaded=True, request_handler=QuietHandler
+            )
+            Thread(target=HTTPDriver.server.serve_forever, daemon=True).start()
+        self.base = "http://127.0.0.1:{}".format(HTTPDriver.server.server_port)
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(), NoRedirect()
+        )
+
+    def request(self, method, url, data=None):
+        body = urllib.parse.urlencode(data).encode() if data is not None else None
+        try:
+            with self.opener.open(self.base + url, body) as response:
+                response.read()
+                return response.status, response.headers
+        except urllib.error.HTTPError as e:  # redirects and errors
+            return e.code, e.headers
+
+    def close(self):
+        pass
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    # a redirect is a separate request, and is measured as such
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+def user_actions(users, post_words):
+    """The weighted mix of things a logged in user does."""
+
+    def index(me):
+        return "GET", "/index", None
+
+    def explore(me):
+        return "GET", "/explore", None
+
+    def profile(me):
+        return "GET", "/user/user{}".format(random.randint(1, users)), None
+
+    def follow(me):
+        verb = random.choice(("follow", "unfollow"))
+        return "GET", "/{}/user{}".format(verb, random.randint(1, users)), None
+
+    def post(me):
+        return "POST", "/index", {"post": " ".join(random.sample(post_words, 5))}
+
+    return [(index, 40), (explore, 20), (profile, 20), (follow, 10), (post, 10)]
+
+
+def bench_routes(args):
+    """Latency, queries per request and throughput of the main pages on a seeded social graph."""
+    app.config["WTF_CSRF_ENABLED"] = False
+    app.config["TIMELINE_MODEL"] = args.timeline
+    report = {"parameters": {k: v for k, v in vars(args).items() if k != "func"}}
+    report["commit"] = git_commit()
+    driver_class = HTTPDriver if args.server else TestClientDriver
+    words = ["word{}".format(i) for i in range(1000)]
+    with tempfile.TemporaryDirectory() as tmp:
+        use_database(os.path.join(tmp, "bench.db"))
+        print("Seeding {} users...".format(args.users))
+        report["seed_seconds"] = seed(
+            args.users, args.follows, args.posts, words, args.distribution
+        )
+        db.engine.execute(
+            User.__table__.update().values(passowrd_hash=generate_password_hash("cat"))
+        )
+        reconcile_counters()
+        if args.timeline == "fanout":
+            rebuild_timelines()
+        db.session.remove()
+        QueryCounter().install()
+
+        actions = user_actions(args.users, words)
+        names = [action.__name__ for action, _ in actions]
+        cum_weights = list(itertools.accumulate(weight for _, weight in actions))
+        results = {name: ([], []) for name in names}
+        lock = Lock()
+
+        def client(n, requests):
+            rng = random.Random(args.seed + n)
+            driver = driver_class()
+            me = rng.randint(1, args.users)
+            driver.request(
+                "POST", "/login", {"username": "user{}".format(me), "password": "cat"}
+            )
+            for i in range(requests):
+                action = rng.choices(actions, cum_weights=cum_weights)[0][0]
+                method, url, data = action(me)
+                started = time.perf_counter()
+                status, headers = driver.request(method, url, data)
+                elapsed = (time.perf_counter() - started) * 1000
+                if status >= 400:
+                    raise RuntimeError("{} {} returned {}".format(method, url, status))
+                if i >= args.warmup:
+                    with lock:
+                        timings, queries = results[action.__name__]
+                        timings.append(elapsed)
+                        queries.append(int(headers.get("X-Bench-Queries", 0)))
+            driver.close()
+
+        started = time.perf_counter()
+        per_client = args.requests // args.clients
+        threads = [
+            Thread(target=client, args=(n, per_client + args.warmup))
+            for n in range(args.clients)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        last_seen.stop()  # writes the pending times while the database still exists
+        db.session.remove()
+
+    report["routes"] = {}
+    all_timings, all_queries = [], []
+    print(
+        "\n{:10} {:>8} {:>9} {:>9} {:>9} {:>8}".format(
+            "route", "requests", "p50 ms", "p95 ms", "p99 ms", "queries"
+        )
+    )
+    for name in names + ["all"]:
+        if name == "all":
+            timings, queries = all_timings, all_queries
+        else:
+            timings, queries = results[name]
+            all_timings += timings
+            all_queries += queries
+        if not timings:
+            continue
+        summary = report["routes"][name] = summarize(timings, queries, elapsed)
+        print(
+            "{:10} {:8d} {:9.2f} {:9.2f} {:9.2f} {:8.1f}".format(
+                name,
+                summary["requests"],
+                summary["p50_ms"],
+                summary["p95_ms"],
+                summary["p99_ms"],
+                summary["mean_queries"],
+            )
+        )
+    print("\n{:.1f} requests/s".format(report["routes"]["all"]["requests_per_second"]))
+    return report
+
+
+def bench_concurrency(args):
+    """Requests per second of a read-mostly mix with 1 to N threads, for each SQLite profile."""
+    app.config["WTF_CSRF_ENABLED"] = False
+    report = {"parameters": {k: v for k, v in vars(args).items() if k != "func"}}
+    report["commit"] = git_commit()
+    driver_class = HTTPDriver if args.server else TestClientDriver
+    words = ["word{}".format(i) for i in range(1000)]
+    actions = user_actions(args.users, words)
+    cum_weights = list(itertools.accumulate(weight for _, weight in actions))
+    QueryCounter().install()
+    print(
+        "{:8} {:>7} {:>9} {:>9} {:>9} {:>7}".format(
+            "profile", "threads", "req/s", "p50 ms", "p95 ms", "errors"
+        )
+    )
+    with tempfile.TemporaryDirectory() as tmp:
+        for profile in args.profiles:
+            app.config["SQLITE_PROFILE"] = profile
+            use_database(os.path.join(tmp, "{}.db".format(profile)))
+            seed(args.users, args.follows, args.posts, words)
+            db.engine.execute(
+                User.__table__.update().values(
+                    passowrd_hash=generate_password_hash("cat")
+                )
+            )
+            reconcile_counters()
+            db.session.remove()
+            # the caches of the process still hold the previous database
+            follow_cache.clear()
+            session_users.clear()
+            recent_posts.clear()
+            report[profile] = {}
+            for threads in args.threads:
+                timings, queries, errors = [], [], []
+                lock = Lock()
+
+                def client(n, requests):
+                    rng = random.Random(args.seed + n)
+                    driver = driver_class()
+                    me = rng.randint(1, args.users)
+                    driver.request(
+                        "POST",
+                        "/login",
+                        {"username": "user{}".format(me), "password": "cat"},
+                    )
+                    for _ in range(requests):
+                        action = rng.choices(actions, cum_weights=cum_weights)[0][0]
+                        method, url, data = action(me)
+                        started = time.perf_counter()
+                        status, headers = driver.request(method, url, data)
+                        elapsed = (time.perf_counter() - started) * 1000
+                        with lock:
+                            # "database is locked" shows up as a 500
+                            if status >= 500:
+                                errors.append(url)
+                            timings.append(elapsed)
+                            queries.append(int(headers.get("X-Bench-Queries", 0)))
+                    driver.close()
+
+                clients = [
+                    Thread(target=client, args=(n, args.requests // threads))
+                    for n in range(threads)
+                ]
+                started = time.perf_counter()
+                for thread in clients:
+                    thread.start()
+                for thread in clients:
+                    thread.join()
+                result = summarize(timings, queries, time.perf_counter() - started)
+                result["errors"] = len(errors)
+                report[profile][threads] = result
+                print(
+                    "{:8} {:7d} {:9.1f} {:9.2f} {:9.2f} {:7d}".format(
+                        profile,
+                        threads,
+                        result["requests_per_second"],
+                        result["p50_ms"],
+                        result["p95_ms"],
+                        result["errors"],
+                    )
+                )
+            last_seen.flush()
+            db.session.remove()
+            for engine in [db.engine] + list(db.readers.values()):
+                engine.dispose()
+        last_seen.stop()
+    return report
+
+
+def bench_parallel(args):
+    """The user page with its queries run in order or by gather(), with a slow database."""
+    app.config["WTF_CSRF_ENABLED"] = False
+    report = {"parameters": {k: v for k, v in vars(args).items() if k != "func"}}
+    with tempfile.TemporaryDirectory() as tmp:
+        use_database(os.path.join(tmp, "bench.db"))
+        print("Seeding {} users...".format(args.users))
+        seed(args.users, args.follows, args.posts)
+        db.engine.execute(
+            User.__table__.update().values(passowrd_hash=generate_password_hash("cat"))
+        )
+        reconcile_counters()
+        db.session.remove()
+
+        # stands in for the network round trip to a database server
+        def round_trip(conn, cursor, statement, parameters, context, executemany):
+            time.sleep(args.latency / 1000)
+
+        engines = [db.engine, *db.readers.values()]
+        for engine in engines:
+            event.listen(engine, "before_cursor_execute", round_trip)
+        driver = TestClientDriver()
+        driver.request("POST", "/login", {"username": "user1", "password": "cat"})
+        print("{:8} {:>9} {:>9} {:>9}".format("workers", "p50 ms", "p95 ms", "p99 ms"))
+        for workers in args.workers:
+            app.config["QUERY_WORKERS"] = workers
+            timings = []
+            for _ in range(args.requests):
+                # every request asks the database, like the first view of a profile
+                follow_cache.clear()
+                url = "/user/user{}".format(random.randint(1, args.users))
+                started = time.perf_counter()
+                status, _ = driver.request("GET", url)
+                timings.append((time.perf_counter() - started) * 1000)
+                assert status == 200, status
+            result = report[workers] = {
+                "p50_ms": percentile(timings, 0.50),
+                "p95_ms": percentile(timings, 0.95),
+                "p99_ms": percentile(timings, 0.99),
+            }
+            print(
+                "{:8d} {:9.2f} {:9.2f} {:9.2f}".format(
+                    workers, result["p50_ms"], result["p95_ms"], result["p99_ms"]
+                )
+            )
+        for engine in engines:
+            event.remove(engine, "before_cursor_execute", round_trip)
+        last_seen.stop()
+        db.session.remove()
+    return report
+
+
+def bench_explore(args):
+    """Explore page throughput with and without the newest posts kept in memory."""
+    app.config["WTF_CSRF_ENABLED"] = False
+    report = {"parameters": {k: v for k, v in vars(args).items() if k != "func"}}
+    with tempfile.TemporaryDirectory() as tmp:
+        use_database(os.path.join(tmp, "bench.db"))
+        print("Seeding {} users...".format(args.users))
+        seed(args.users, args.follows, args.posts)
+        db.engine.execute(
+            User.__table__.update().values(passowrd_hash=generate_password_hash("cat"))
+        )
+        reconcile_counters()
+
+        # the ?before= cursor of each of the first pages, None for the first one
+        per_page = app.config["POSTS_PER_PAGE"]
+        newest = (
+            Post.query.order_by(Post.timestamp.desc(), Post.id.desc())
+            .limit(per_page * args.pages)
+            .all()
+        )
+        cursors = [None] + [
+            encode_cursor(post.timestamp, post.id)
+            for post in newest[per_page - 1 :: per_page]
+        ][: args.pages - 1]
+        db.session.remove()
+
+        QueryCounter().install()
+        driver = TestClientDriver()
+        driver.request("POST", "/login", {"username": "user1", "password": "cat"})
+        print(
+            "{:>8} {:>9} {:>9} {:>9} {:>9} {:>9}".format(
+                "buffer", "p50 ms", "p95 ms", "queries", "req/s", "KiB"
+            )
+        )
+        for size in args.sizes:
+            recent_posts.maxlen = size
+            recent_posts.clear()
+            driver.request("GET", "/explore")  # loads the buffer
+            timings, queries = [], []
+            started = time.perf_counter()
+            for _ in range(args.requests):
+                cursor = random.choice(cursors)
+                url = "/explore?before={}".format(cursor) if cursor else "/explore"
+                request_started = time.perf_counter()
+                status, headers = driver.request("GET", url)
+                timings.append((time.perf_counter() - request_started) * 1000)
+                queries.append(int(headers.get("X-Bench-Queries", 0)))
+                assert status == 200, status
+            result = report[size] = summarize(
+                timings, queries, time.perf_counter() - started
+            )
+            result["buffer_bytes"] = recent_posts._bytes
+            print(
+                "{:8d} {:9.2f} {:9.2f} {:9.2f} {:9.1f} {:9.1f}".format(
+                    size,
+                    result["p50_ms"],
+                    result["p95_ms"],
+                    result["mean_queries"],
+                    result["requests_per_second"],
+                    result["buffer_bytes"] / 1024,
+                )
+            )
+        last_seen.stop()
+        db.session.remove()
+    return report
+
+
+def bench_compare(args):
+    """Compare two JSON reports of the routes benchmark, e.g. from two commits."""
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    print("{} -> {}".format(old.get("commit"), new.get("commit")))
+    metrics = ("p50_ms", "p95_ms", "p99_ms", "mean_queries", "requests_per_second")
+    report = {}
+    for route in new["routes"]:
+        if route not in old["routes"]:
+            continue
+        report[route] = {}
+        changes = []
+        for metric in metrics:
+            before, after = old["routes"][route][metric], new["routes"][route][metric]
+            change = (after - before) / before * 100 if before else 0.0
+            report[route][metric] = {
+                "old": before,
+                "new": after,
+                "change_percent": change,
+            }
+            changes.append("{} {:+.1f}%".format(metric, change))
+        print("{:10} {}".format(route, ", ".join(changes)))
+    return report
+
+
+def git_commit():
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "--short", "HEAD"],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stderr=subprocess.DEVNULL,
+            )
+            .decode()
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--json", metavar="FILE", help="also write the results to FILE")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    commands = parser.add_subparsers(dest="benchmark")
+    commands.required = True
+
+    indexes = commands.add_parser("indexes", help=bench_indexes.__doc__)
+    indexes.add_argument("--users", type=int, default=100000)
+    indexes.add_argument("--follows", type=int, default=100, help="follows per user")
+    indexes.add_argument("--posts", type=int, default=10, help="posts per user")
+    indexes.add_argument("--samples", type=int, default=200)
+    indexes.set_defaults(func=bench_indexes)
+
+    avatar = commands.add_parser("avatar", help=bench_avatar.__doc__)
+    avatar.add_argument("--calls", type=int, default=100000)
+    avatar.set_defaults(func=bench_avatar)
+
+    passwords = commands.add_parser("passwords", help=bench_passwords.__doc__)
+    passwords.add_argument(
+        "--methods",
+        nargs="+",
+        default=["pbkdf2:sha256:150000", "pbkdf2:sha256:50000"],
+        help="werkzeug password hash methods",
+    )
+    passwords.add_argument(
+        "--workers",
+        type=int,
+        nargs="+",
+        default=[0, os.cpu_count()],
+        help="hashing processes, 0 hashes in the request threads",
+    )
+    passwords.add_argument("--threads", type=int, default=8, help="request threads")
+    passwords.add_argument("--logins", type=int, default=200)
+    passwords.set_defaults(func=bench_passwords)
+
+    suggestions = commands.add_parser("suggestions", help=bench_suggestions.__doc__)
+    suggestions.add_argument("--users", type=int, default=100000)
+    suggestions.add_argument("--follows", type=int, default=20, help="per user")
+    suggestions.add_argument(
+        "--distribution", choices=["uniform", "powerlaw"], default="powerlaw"
+    )
+    suggestions.add_argument("-k", type=int, default=20, help="suggestions per user")
+    suggestions.add_argument("--block-size", type=int, default=10000)
+    suggestions.add_argument("--runs", type=int, default=1)
+    suggestions.set_defaults(func=bench_suggestions)
+
+    search = commands.add_parser("search", help=bench_search.__doc__)
+    search.add_argument("--posts", type=int, default=2000000)
+    search.add_argument("--words", type=int, default=5000, help="vocabulary size")
+    search.add_argument("--samples", type=int, default=20)
+    search.set_defaults(func=bench_search)
+
+    routes = commands.add_parser("routes", help=bench_routes.__doc__)
+    routes.add_argument("--users", type=int, default=10000)
+    routes.add_argument("--follows", type=int, default=50, help="mean follows per user")
+    routes.add_argument("--posts", type=int, default=20, help="posts per user")
+    routes.add_argument(
+        "--distribution", choices=("powerlaw", "uniform"), default="powerlaw"
+    )
+    routes.add_argument("--timeline", choices=("pull", "fanout"), default="pull")
+    routes.add_argument("--requests", type=int, default=2000)
+    routes.add_argument("--warmup", type=int, default=20, help="per client")
+    routes.add_argument("--clients", type=int, default=1, help="concurrent clients")
+    routes.add_argument(
+        "--server", action="store_true", help="go through a local WSGI server"
+    )
+    routes.set_defaults(func=bench_routes)
+
+    concurrency = commands.add_parser("concurrency", help=bench_concurrency.__doc__)
+    concurrency.add_argument("--users", type=int, default=1000)
+    concurrency.add_argument("--follows", type=int, default=20, help="follows per user")
+    concurrency.add_argument("--posts", type=int, default=20, help="posts per user")
+    concurrency.add_argument(
+        "--profiles", nargs="+", default=["default", "wal"], help="SQLITE_PROFILE"
+    )
+    concurrency.add_argument("--threads", type=int, nargs="+", default=[1, 8, 32])
+    concurrency.add_argument("--requests", type=int, default=1000, help="per run")
+    concurrency.add_argument(
+        "--server", action="store_true", help="go through a local WSGI server"
+    )
+    concurrency.set_defaults(func=bench_concurrency)
+
+    parallel = commands.add_parser("parallel", help=bench_parallel.__doc__)
+    parallel.add_argument("--users", type=int, default=1000)
+    parallel.add_argument("--follows", type=int, default=20, help="follows per user")
+    parallel.add_argument("--posts", type=int, default=20, help="posts per user")
+    parallel.add_argument(
+        "--latency", type=float, default=5, help="milliseconds added to every query"
+    )
+    parallel.add_argument("--workers", type=int, nargs="+", default=[0, 4])
+    parallel.add_argument("--requests", type=int, default=200)
+    parallel.set_defaults(func=bench_parallel)
+
+    explore = commands.add_parser("explore", help=bench_explore.__doc__)
+    explore.add_argument("--users", type=int, default=1000)
+    explore.add_argument("--follows", type=int, default=20, help="follows per user")
+    explore.add_argument("--posts", type=int, default=20, help="posts per user")
+    explore.add_argument(
+        "--pages", type=int, default=5, help="requests spread over the first pages"
+    )
+    explore.add_argument(
+        "--sizes", type=int, nargs="+", default=[0, 1000], help="RECENT_POSTS_SIZE"
+    )
+    explore.add_argument("--requests", type=int, default=500)
+    explore.set_defaults(func=bench_explore)
+
+    compare = commands.add_parser("compare", help=bench_compare.__doc__)
+    compare.add_argument("old")
+    compare.add_argument("new")
+    compare.set_defaults(func=bench_compare)
+
+    args = parser.parse_args()
+    random.seed(args.seed)
+    report = args.func(args)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2, default=str)
+
+
+if __name__ == "__main__":
+    main()
@@ -13,7 +13,34 @@ class Config:
         basedir, "app.db"
     )  # See chapter 4 for explanation
     SQLALCHEMY_TRACK_MODIFICATIONS = False  # See chapter 4 for explanation
+    # "wal" turns on WAL journaling and sends read-only requests to a pool of SQLITE_READERS
+    # connections, with one connection for writes, see app/database.py. Only for SQLite files.
+    SQLITE_PROFILE = os.environ.get("SQLITE_PROFILE") or "default"
+    SQLITE_READERS = int(os.environ.get("SQLITE_READERS") or 8)
+    SQLITE_BUSY_TIMEOUT = float(os.environ.get("SQLITE_BUSY_TIMEOUT") or 5)  # seconds
+    SQLITE_MMAP_SIZE = int(os.environ.get("SQLITE_MMAP_SIZE") or 256 * 1024 * 1024)  # bytes
+    SQLITE_CACHE_SIZE = int(os.environ.get("SQLITE_CACHE_SIZE") or 64 * 1024)  # KiB
+    # read-only requests read from this database, see app/database.py. A user who has written
+    # something reads from the primary for the next REPLICA_STICKY_SECONDS.
+    SQLALCHEMY_REPLICA_URI = os.environ.get("DATABASE_REPLICA_URL")
+    REPLICA_STICKY_SECONDS = float(os.environ.get("REPLICA_STICKY_SECONDS") or 10)
     POSTS_PER_PAGE = 3
+    # "pull" builds the home timeline with a query on every request (followed_posts UNION),
+    # "fanout" copies every new post into the timeline table of each follower on write.
+    # Run `flask timeline backfill` after switching an existing database to "fanout".
+    TIMELINE_MODEL = os.environ.get("TIMELINE_MODEL") or "pull"
+    # is_following() answers shared across requests, see app/models.py. Other processes see a
+    # follow or unfollow right away with FRAGMENT_CACHE_URL set, otherwise after FOLLOW_CACHE_TTL.
+    FOLLOW_CACHE_SIZE = int(os.environ.get("FOLLOW_CACHE_SIZE") or 10000)
+    FOLLOW_CACHE_TTL = int(os.environ.get("FOLLOW_CACHE_TTL") or 300)  # seconds
+    # snapshots of the logged in users, so load_user() does not query, see app/models.py. Other
+    # processes see changes right away with FRAGMENT_CACHE_URL set, otherwise after the TTL.
+    SESSION_USER_CACHE_SIZE = int(os.environ.get("SESSION_USER_CACHE_SIZE") or 10000)
+    SESSION_USER_CACHE_TTL = int(os.environ.get("SESSION_USER_CACHE_TTL") or 300)  # seconds
+    # user.last_seen is only updated when older than LAST_SEEN_GRANULARITY seconds,
+    # and pending updates are written every LAST_SEEN_FLUSH_INTERVAL seconds
+    LAST_SEEN_GRANULARITY = int(os.environ.get("LAST_SEEN_GRANULARITY") or 60)
+    LAST_SEEN_FLUSH_INTERVAL = int(os.environ.get("LAST_SEEN_FLUSH_INTERVAL") or 10)
 
     # mail configuration
     MAIL_SERVER = os.environ.get("MAIL_SERVER")
@@ -21,7 +48,86 @@ class Config:
     MAIL_USE_TLS = os.environ.get("MAIL_USE_TLS") is not None
     MAIL_USERNAME = os.environ.get("MAIL_USERNAME")
     MAIL_PASSWORD = os.environ.get("MAIL_PASSWORD")
+    # outgoing mail worker pool, see app/email.py
+    MAIL_WORKERS = int(os.environ.get("MAIL_WORKERS") or 2)
+    MAIL_QUEUE_SIZE = int(os.environ.get("MAIL_QUEUE_SIZE") or 1000)
+    MAIL_QUEUE_TIMEOUT = float(os.environ.get("MAIL_QUEUE_TIMEOUT") or 1)  # seconds
+    MAIL_BATCH_SIZE = int(os.environ.get("MAIL_BATCH_SIZE") or 50)
+    MAIL_RETRIES = int(os.environ.get("MAIL_RETRIES") or 3)
+    MAIL_RETRY_BACKOFF = float(os.environ.get("MAIL_RETRY_BACKOFF") or 1)  # seconds
+    MAIL_IDLE_TIMEOUT = float(os.environ.get("MAIL_IDLE_TIMEOUT") or 30)  # seconds
     ADMINS = ["sainimohit23@gmail.com"]
 
+    # rendered HTML cache, see app/fragments.py. FRAGMENT_CACHE_URL (e.g. redis://localhost/0)
+    # adds a cache shared by all processes. PAGE_CACHE_TTL = 0 turns off whole-page caching.
+    FRAGMENT_CACHE_SIZE = int(os.environ.get("FRAGMENT_CACHE_SIZE") or 10000)
+    FRAGMENT_CACHE_TTL = int(os.environ.get("FRAGMENT_CACHE_TTL") or 3600)  # seconds
+    FRAGMENT_CACHE_URL = os.environ.get("FRAGMENT_CACHE_URL")
+    PAGE_CACHE_TTL = int(os.environ.get("PAGE_CACHE_TTL") or 0)  # seconds
+
+    # newest posts kept in the memory of every process for the explore page, see app/recent.py.
+    # RECENT_POSTS_SIZE = 0 turns it off, RECENT_POSTS_NOTIFY_URL (e.g. redis://localhost/0)
+    # tells the other processes about new posts right away.
+    RECENT_POSTS_SIZE = int(os.environ.get("RECENT_POSTS_SIZE") or 1000)
+    RECENT_POSTS_MAX_BYTES = int(os.environ.get("RECENT_POSTS_MAX_BYTES") or 4 * 1024 * 1024)
+    RECENT_POSTS_SYNC_INTERVAL = float(
+        os.environ.get("RECENT_POSTS_SYNC_INTERVAL") or 1
+    )  # seconds
+    RECENT_POSTS_REFRESH_INTERVAL = float(
+        os.environ.get("RECENT_POSTS_REFRESH_INTERVAL") or 300
+    )  # seconds
+    RECENT_POSTS_NOTIFY_URL = os.environ.get("RECENT_POSTS_NOTIFY_URL")
+
+    # full-text search over posts, see app/search.py. "sqlite" uses an FTS5 index,
+    # "like" scans the post table and works with any database.
+    SEARCH_BACKEND = os.environ.get("SEARCH_BACKEND") or (
+        "sqlite" if SQLALCHEMY_DATABASE_URI.startswith("sqlite") else "like"
+    )
+
+    # threads running the independent queries of a page at the same time, see app/parallel.py.
+    # 0 runs them one after another, which is faster with SQLite.
+    QUERY_WORKERS = int(
+        os.environ.get("QUERY_WORKERS")
+        or (0 if SQLALCHEMY_DATABASE_URI.startswith("sqlite") else 4)
+    )
+
+    # number of items the JSON API sends when ?limit= is not given, and the largest
+    # ?limit= it accepts (0 for no limit, the API streams so memory use does not grow)
+    API_DEFAULT_LIMIT = int(os.environ.get("API_DEFAULT_LIMIT") or 100)
+    API_MAX_LIMIT = int(os.environ.get("API_MAX_LIMIT") or 0)
+
+    # who to follow, computed by `flask suggestions compute`, see app/suggestions.py. The job
+    # stores SUGGESTIONS_PER_USER per user, and the panel shows the first SUGGESTIONS_SHOWN.
+    SUGGESTIONS_PER_USER = int(os.environ.get("SUGGESTIONS_PER_USER") or 20)
+    SUGGESTIONS_SHOWN = int(os.environ.get("SUGGESTIONS_SHOWN") or 5)
+
+    # SQL statements counted and timed per request, see app/instrumentation.py. Only a fraction
+    # SQL_METRICS_SAMPLE_RATE of the requests is instrumented (e.g. 0.01 in production).
+    SQL_METRICS_SAMPLE_RATE = float(os.environ.get("SQL_METRICS_SAMPLE_RATE") or 1)
+    SQL_N_PLUS_ONE_THRESHOLD = int(os.environ.get("SQL_N_PLUS_ONE_THRESHOLD") or 5)
+    SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS") or 100)
+    # Prometheus scrapes /metrics with this bearer token, /metrics is off without one
+    METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+
+    # per-endpoint and per-phase latency histograms, and on-demand request profiles written
+    # to PROFILE_DIR, see app/profiling.py. Without PROFILING_TOKEN, only admins can start one.
+    PROFILING_ENABLED = os.environ.get("PROFILING_ENABLED") is not None
+    PROFILING_TOKEN = os.environ.get("PROFILING_TOKEN")
+    PROFILE_DIR = os.environ.get("PROFILE_DIR") or os.path.join(basedir, "profiles")
+    PROFILE_SAMPLE_INTERVAL = float(os.environ.get("PROFILE_SAMPLE_INTERVAL") or 0.001)
+
+    # password hashing, see app/passwords.py. The method is in werkzeug's format
+    # (e.g. pbkdf2:sha256:150000), stored hashes are upgraded when their user logs in.
+    PASSWORD_HASH_METHOD = os.environ.get("PASSWORD_HASH_METHOD") or "pbkdf2:sha256:150000"
+    PASSWORD_SALT_LENGTH = int(os.environ.get("PASSWORD_SALT_LENGTH") or 8)
+    # processes hashing passwords, 0 hashes in the request thread. Set it (e.g. to the number of
+    # cores) in the web server's environment: the pool spawns its processes, which import __main__
+    # again, so a script that hashes passwords needs an `if __name__ == "__main__":` guard.
+    PASSWORD_HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS") or 0)
+    PASSWORD_HASH_QUEUE_SIZE = int(os.environ.get("PASSWORD_HASH_QUEUE_SIZE") or 64)
+    PASSWORD_HASH_QUEUE_TIMEOUT = float(
+        os.environ.get("PASSWORD_HASH_QUEUE_TIMEOUT") or 5
+    )  # seconds
+
     LANGUAGES = ['en', 'es']
 
@@ -0,0 +1,53 @@
+"""follower and author indexes
+
+Revision ID: b7e3f0a2c915
+Revises: 9c1d2e7f4a10
+Create Date: 2026-10-18 10:05:12.604118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7e3f0a2c915'
+down_revision = '9c1d2e7f4a10'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Two concurrent follow requests can both pass is_following() and insert the same edge,
+    # which the table did not prevent. Keep one row of each edge, or the new key cannot be made.
+    followers = sa.table('followers', sa.column('follower_id', sa.Integer),
+                         sa.column('followed_id', sa.Integer))
+    conn = op.get_bind()
+    duplicates = conn.execute(
+        sa.select([followers.c.follower_id, followers.c.followed_id])
+        .group_by(followers.c.follower_id, followers.c.followed_id)
+        .having(sa.func.count() > 1)
+    ).fetchall()
+    for follower_id, followed_id in duplicates:
+        conn.execute(followers.delete().where(sa.and_(followers.c.follower_id == follower_id,
+                                                      followers.c.followed_id == followed_id)))
+        conn.execute(followers.insert().values(follower_id=follower_id, followed_id=followed_id))
+
+    # SQLite cannot add a primary key to an existing table, so the followers table is
+    # recreated by batch mode.
+    with op.batch_alter_table('followers', recreate='always') as batch_op:
+        batch_op.alter_column('follower_id', existing_type=sa.Integer(), nullable=False)
+        batch_op.alter_column('followed_id', existing_type=sa.Integer(), nullable=False)
+        batch_op.create_primary_key('pk_followers', ['follower_id', 'followed_id'])
+        batch_op.create_index('ix_followers_followed_id_follower_id', ['followed_id', 'follower_id'], unique=False)
+
+    op.create_index('ix_post_user_id_timestamp', 'post', ['user_id', 'timestamp'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_post_user_id_timestamp', table_name='post')
+
+    with op.batch_alter_table('followers', recreate='always') as batch_op:
+        batch_op.drop_index('ix_followers_followed_id_follower_id')
+        batch_op.drop_constraint('pk_followers', type_='primary')
+        batch_op.alter_column('followed_id', existing_type=sa.Integer(), nullable=True)
+        batch_op.alter_column('follower_id', existing_type=sa.Integer(), nullable=True)
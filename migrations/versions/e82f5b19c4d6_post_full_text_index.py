@@ -0,0 +1,32 @@
+"""post full-text index
+
+Revision ID: e82f5b19c4d6
+Revises: d41a8c6e2b37
+Create Date: 2026-10-18 13:02:51.337260
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'e82f5b19c4d6'
+down_revision = 'd41a8c6e2b37'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # the FTS5 index used by SEARCH_BACKEND = "sqlite", see app/search.py.
+    # Other databases use a different search backend and need nothing here.
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    op.execute("CREATE VIRTUAL TABLE IF NOT EXISTS post_fts "
+               "USING fts5(body, content='post', content_rowid='id')")
+    # index the existing posts
+    op.execute("INSERT INTO post_fts (post_fts) VALUES ('rebuild')")
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    op.execute("DROP TABLE IF EXISTS post_fts")
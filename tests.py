@@ -1,16 +1,93 @@
 from datetime import datetime, timedelta
+import json
+import os
+import pstats
+import shutil
+import tempfile
+import threading
 import unittest
+import warnings
+from flask import g
 from app import app, db
-from app.models import User, Post
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from app.models import User, Post, rebuild_timelines, follow_cache, \
+    followers, session_users, load_user, CachedUser, reconcile_counters
+from app.pagination import paginate_keyset, decode_cursor
+from app.activity import LastSeenTracker, last_seen
+from app.search import add_to_index, query_index
+from app.cache import MISSING
+from app.fragments import fragment_cache
+from app.instrumentation import RequestStats, sql_metrics
+from app.passwords import PasswordHasher, PasswordHasherBusy
+from app.parallel import gather, adopt
+from app.recent import RecentPosts, recent_posts
+from app.email import MailWorkerPool, MailQueueFull, TemplateEmail, \
+    password_reset_recipients
+from flask_mail import Message
+
+try:
+    import scipy
+    from app.suggestions import compute_suggestions
+except ImportError:  # the suggestions job needs numpy and scipy
+    scipy = None
+
+with warnings.catch_warnings():
+    warnings.simplefilter('ignore', DeprecationWarning)
+    try:
+        import asyncore
+        import smtpd
+    except ImportError:  # removed in Python 3.12
+        smtpd = None
 
 class UserModelCase(unittest.TestCase):
     def setUp(self):
         app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        app.config['WTF_CSRF_ENABLED'] = False
         db.create_all()
 
     def tearDown(self):
         db.session.remove()
         db.drop_all()
+        app.config['TIMELINE_MODEL'] = 'pull'
+        app.config['POSTS_PER_PAGE'] = 3
+        app.config['SEARCH_BACKEND'] = 'sqlite'
+        app.config['PAGE_CACHE_TTL'] = 0
+        app.config['SQL_METRICS_SAMPLE_RATE'] = 1
+        app.config['QUERY_WORKERS'] = 0
+        app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:150000'
+        app.config['METRICS_TOKEN'] = None
+        follow_cache.clear()
+        session_users.clear()
+        sql_metrics.clear()
+        recent_posts.clear()
+        fragment_cache.local.clear()
+
+    def login(self, username, password='cat'):
+        client = app.test_client()
+        client.post('/login', data={'username': username,
+                                    'password': password})
+        return client
+
+    def get_metrics(self, client):
+        app.config['METRICS_TOKEN'] = 'scraper'
+        response = client.get('/metrics',
+                              headers={'Authorization': 'Bearer scraper'})
+        return response.data.decode()
+
+    def count_queries(self, func, table=None):
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            if table is None or table in statement:
+                statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            result = func()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        return result, len(statements)
 
     def test_password_hashing(self):
         u = User(username='susan')
@@ -18,11 +95,43 @@ class UserModelCase(unittest.TestCase):
         self.assertFalse(u.check_password('dog'))
         self.assertTrue(u.check_password('cat'))
 
+    def test_password_rehash_on_login(self):
+        app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:1000'
+        u = User(username='susan', email='susan@example.com')
+        u.set_password('cat')
+        db.session.add(u)
+        db.session.commit()
+        self.assertTrue(u.passowrd_hash.startswith('pbkdf2:sha256:1000$'))
+
+        app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256'
+        self.login('susan', 'dog')
+        u = User.query.filter_by(username='susan').first()
+        self.assertTrue(u.passowrd_hash.startswith('pbkdf2:sha256:1000$'))
+        self.login('susan')
+        u = User.query.filter_by(username='susan').first()
+        self.assertTrue(u.passowrd_hash.startswith('pbkdf2:sha256:150000$'))
+        self.assertTrue(u.check_password('cat'))
+
+    def test_password_hasher_busy(self):
+        hasher = PasswordHasher(workers=1, queue_size=1, timeout=0)
+        try:
+            pwhash = hasher.hash('cat')
+            self.assertTrue(hasher.verify(pwhash, 'cat'))
+            hasher._slots.acquire()
+            self.assertRaises(PasswordHasherBusy, hasher.verify, pwhash, 'cat')
+        finally:
+            hasher.shutdown()
+
     def test_avatar(self):
         u = User(username='john', email='john@example.com')
         self.assertEqual(u.avatar(128), ('https://www.gravatar.com/avatar/'
                                          'd4c74594d841139328695756648b6bd6'
                                          '?d=identicon&s=128'))
+        self.assertEqual(u.avatar_hash, 'd4c74594d841139328695756648b6bd6')
+        u.email = 'John@Example.com'
+        self.assertEqual(u.avatar_hash, 'd4c74594d841139328695756648b6bd6')
+        u.email = 'susan@example.com'
+        self.assertNotEqual(u.avatar_hash, 'd4c74594d841139328695756648b6bd6')
 
     def test_follow(self):
         u1 = User(username='john', email='john@example.com')
@@ -47,6 +156,165 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(u1.followed.count(), 0)
         self.assertEqual(u2.followers.count(), 0)
 
+    def test_follow_graph_cache(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+
+        def graph():
+            return (u1.is_following(u2), u1.following_count,
+                    u2.follower_count)
+
+        # the counts are columns of the user, only is_following() is a query
+        self.assertEqual(self.count_queries(graph, 'followers'), ((False, 0, 0), 1))
+        self.assertEqual(self.count_queries(graph, 'followers'), ((False, 0, 0), 0))
+
+        # uncommitted changes are read from the database, not the cache
+        u1.follow(u2)
+        self.assertEqual(graph(), (True, 1, 1))
+        db.session.rollback()
+        self.assertEqual(self.count_queries(graph, 'followers'), ((False, 0, 0), 0))
+
+        u1.follow(u2)
+        db.session.commit()
+        self.assertEqual(self.count_queries(graph, 'followers'), ((True, 1, 1), 1))
+        self.assertEqual(self.count_queries(graph, 'followers'), ((True, 1, 1), 0))
+
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual(graph(), (False, 0, 0))
+
+        # another process committed a follow: its bump of the generation hides this
+        # process's copy of the old answer
+        self.assertEqual(self.count_queries(graph, 'followers'), ((False, 0, 0), 0))
+        db.session.execute(followers.insert().values(follower_id=u1.id,
+                                                     followed_id=u2.id))
+        db.session.commit()
+        fragment_cache.bump('follows:{}'.format(u1.id))
+        self.assertEqual(self.count_queries(lambda: u1.is_following(u2),
+                                            'followers'), (True, 1))
+
+        # generations never go back, even when the fragment cache drops its entries
+        name = 'follows:{}'.format(u1.id)
+        generation = fragment_cache.generation(name)
+        fragment_cache.local.clear()
+        self.assertEqual(fragment_cache.generation(name), generation)
+        # and a commit drops the follower's answers cached under any generation
+        older = ('is_following', u1.id, u2.id, generation - 1)
+        follow_cache.set(older, True)
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertIs(follow_cache.get(older), MISSING)
+        self.assertEqual(fragment_cache.generation(name), generation + 1)
+        self.assertFalse(u1.is_following(u2))
+
+    def test_counters(self):
+        u1 = User(username='john', email='john@example.com')
+        u1.set_password('cat')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.add_all([Post(body='post {}'.format(i), author=u2)
+                            for i in range(3)])
+        db.session.commit()
+        self.assertEqual((u1.post_count, u2.post_count), (0, 3))
+
+        u1.follow(u2)
+        self.assertEqual((u1.following_count, u2.follower_count), (1, 1))
+        db.session.rollback()
+        self.assertEqual((u1.following_count, u2.follower_count), (0, 0))
+        u1.follow(u2)
+        db.session.delete(u2.posts.first())
+        db.session.commit()
+        self.assertEqual((u1.following_count, u1.follower_count,
+                          u2.follower_count, u2.post_count), (1, 0, 1, 2))
+
+        client = self.login('john')
+        client.post('/index', data={'post': 'hello'})
+        self.assertIn(b'2 posts, 1 followers, 0 following.',
+                      client.get('/user/susan').data)
+        client.get('/unfollow/susan')
+        self.assertIn(b'1 posts, 0 followers, 0 following.',
+                      client.get('/user/john').data)
+
+        # rows written behind the ORM's back
+        db.engine.execute(Post.__table__.insert(), [{'body': 'x', 'user_id': 1}])
+        db.engine.execute(User.__table__.update().values(follower_count=5))
+        result = app.test_cli_runner().invoke(args=['counters', 'reconcile'])
+        self.assertIn('Fixed the counters of 2 users.', result.output)
+        u1, u2 = User.query.order_by(User.id).all()
+        self.assertEqual((u1.post_count, u1.follower_count, u2.follower_count),
+                         (2, 0, 0))
+        self.assertEqual(reconcile_counters(), 0)
+
+    def test_session_user_cache(self):
+        u1 = User(username='john', email='john@example.com')
+        u1.set_password('cat')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+
+        with app.test_request_context():
+            user, n = self.count_queries(lambda: load_user('1'), 'FROM user')
+            self.assertEqual((n, user.username), (1, 'john'))
+        with app.test_request_context():
+            user, n = self.count_queries(lambda: load_user('1'), 'FROM user')
+            self.assertIsInstance(user, CachedUser)
+            self.assertEqual(n, 0)
+            susan = User.query.get(2)
+            _, n = self.count_queries(
+                lambda: (user.username, user.avatar(36),
+                         user.is_following(susan),
+                         user.followed_posts().all()), 'FROM user')
+            self.assertEqual(n, 0)
+            self.assertEqual(user.email, 'john@example.com')  # loads the row
+            self.assertEqual(user, User.query.get(1))
+
+        client = self.login('john')
+        client.post('/edit_profile', data={'username': 'johnny',
+                                           'about_me': 'hi'})
+        self.assertIn(b'Hi, johnny!', client.get('/index').data)
+        with app.test_request_context():
+            stale = load_user('1')
+        client.get('/follow/susan')
+        # another process still has the snapshot from before the follow
+        session_users.set(stale._key, stale._snapshot)
+        with app.test_request_context():
+            self.assertTrue(load_user('1').is_following(User.query.get(2)))
+            self.assertIsNotNone(load_user('1').follows_changed_at)
+
+    def test_last_seen_tracker(self):
+        then = datetime.utcnow() - timedelta(hours=1)
+        u = User(username='john', email='john@example.com', last_seen=then)
+        db.session.add(u)
+        db.session.commit()
+        tracker = LastSeenTracker(granularity=60, interval=3600)
+
+        now = datetime.utcnow()
+        _, writes = self.count_queries(lambda: tracker.touch(u, now), 'UPDATE')
+        self.assertEqual(writes, 0)
+        self.assertEqual(u.last_seen, now)
+        self.assertFalse(db.session.dirty)
+        # within the granularity nothing new is recorded
+        tracker.touch(u, now + timedelta(seconds=30))
+
+        self.assertEqual(tracker.flush(), 1)
+        self.assertEqual(tracker.flush(), 0)
+        db.session.expire_all()
+        self.assertEqual(User.query.get(u.id).last_seen, now)
+        tracker.stop()
+
+        # two requests within the granularity queue one write
+        u.set_password('cat')
+        u.last_seen = then
+        db.session.commit()
+        client = self.login('john')
+        last_seen.flush()
+        client.get('/explore')
+        self.assertEqual(last_seen.flush(), 1)
+        client.get('/explore')
+        self.assertEqual(last_seen.flush(), 0)
+
     def test_follow_posts(self):
         # create four users
         u1 = User(username='john', email='john@example.com')
@@ -85,5 +353,731 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f3, [p3, p4])
         self.assertEqual(f4, [p4])
 
+    def test_follow_posts_fanout(self):
+        app.config['TIMELINE_MODEL'] = 'fanout'
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+
+        # john follows susan before she posts, mary follows susan afterwards
+        u1.follow(u2)
+        db.session.commit()
+        now = datetime.utcnow()
+        p1 = Post(body="post from john", author=u1,
+                  timestamp=now + timedelta(seconds=1))
+        p2 = Post(body="post from susan", author=u2,
+                  timestamp=now + timedelta(seconds=2))
+        for p in (p1, p2):
+            db.session.add(p)
+            p.fan_out()
+        db.session.commit()
+        u3.follow(u2)
+        db.session.commit()
+
+        self.assertEqual(u1.followed_posts().all(), [p2, p1])
+        self.assertEqual(u2.followed_posts().all(), [p2])
+        self.assertEqual(u3.followed_posts().all(), [p2])
+
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual(u1.followed_posts().all(), [p1])
+
+        # a backfill produces the same timelines
+        self.assertEqual(rebuild_timelines(), 3)
+        self.assertEqual(u1.followed_posts().all(), [p1])
+        self.assertEqual(u3.followed_posts().all(), [p2])
+
+    def test_keyset_pagination(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        now = datetime.utcnow()
+        # two posts share a timestamp, the id breaks the tie
+        posts = [Post(body="post {}".format(i), author=u1 if i % 2 else u2,
+                      timestamp=now + timedelta(seconds=min(i, 3)))
+                 for i in range(5)]
+        db.session.add_all(posts)
+        u1.follow(u2)
+        db.session.commit()
+        newest_first = sorted(posts, key=lambda p: (p.timestamp, p.id),
+                              reverse=True)
+
+        query = u1.followed_posts()
+        order = u1.followed_posts_order()
+        seen = []
+        page = paginate_keyset(query, order, 2)
+        self.assertFalse(page.has_prev)
+        while True:
+            seen.extend(page.items)
+            if not page.has_next:
+                break
+            page = paginate_keyset(query, order, 2,
+                                   before=decode_cursor(page.next_cursor))
+        self.assertEqual(seen, newest_first)
+
+        # walking back from the last page gives the previous pages again
+        page = paginate_keyset(query, order, 2,
+                               after=decode_cursor(page.prev_cursor))
+        self.assertEqual(page.items, newest_first[2:4])
+        page = paginate_keyset(query, order, 2,
+                               after=decode_cursor(page.prev_cursor))
+        self.assertEqual(page.items, newest_first[:2])
+        self.assertFalse(page.has_prev)
+        self.assertTrue(page.has_next)
+
+        self.assertRaises(ValueError, decode_cursor, 'not-a-cursor')
+
+    def test_timeline_query_count(self):
+        # one post from each of 12 users, all followed by john
+        now = datetime.utcnow()
+        u = User(username='john', email='john@example.com')
+        u.set_password('cat')
+        db.session.add(u)
+        for i in range(12):
+            author = User(username='user{}'.format(i),
+                          email='user{}@example.com'.format(i))
+            db.session.add(Post(body='post {}'.format(i), author=author,
+                                timestamp=now + timedelta(seconds=i)))
+            u.follow(author)
+        db.session.commit()
+        client = self.login('john')
+
+        for url in ('/index', '/explore', '/user/user3'):
+            client.get(url)  # warm up the follow-graph cache
+            counts = []
+            for per_page in (2, 10):
+                app.config['POSTS_PER_PAGE'] = per_page
+                db.session.expunge_all()
+                _, n = self.count_queries(lambda: client.get(url))
+                counts.append(n)
+            self.assertEqual(counts[0], counts[1], url)
+
+    def test_recent_posts(self):
+        u1 = User(username='john', email='john@example.com')
+        u1.set_password('cat')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        now = datetime.utcnow()
+        db.session.add_all([Post(body='post {}'.format(i), author=u2,
+                                 timestamp=now - timedelta(seconds=10 - i))
+                            for i in range(8)])
+        db.session.commit()
+        client = self.login('john')
+
+        # the first pages come from memory, new posts and usernames show up
+        client.get('/explore')
+        response, n = self.count_queries(lambda: client.get('/explore'),
+                                         'FROM post')
+        self.assertEqual(n, 0)
+        self.assertIn(b'post 7', response.data)
+        client.post('/index', data={'post': 'hello'})
+        client.post('/edit_profile', data={'username': 'johnny',
+                                           'about_me': ''})
+        response, n = self.count_queries(lambda: client.get('/explore'),
+                                         'FROM post')
+        self.assertEqual(n, 0)
+        self.assertIn(b'hello', response.data)
+        self.assertIn(b'johnny', response.data)
+
+        # a buffer too small for a page lets the database answer
+        buffer = RecentPosts(4, 10 ** 6, 0, 300, None)
+        order = (Post.timestamp, Post.id)
+        first = buffer.page(3)
+        self.assertEqual([p.body for p in first.items],
+                         ['hello', 'post 7', 'post 6'])
+        second = buffer.page(3, before=decode_cursor(first.next_cursor))
+        self.assertIsNone(second)
+        second = paginate_keyset(Post.query, order, 3,
+                                 before=decode_cursor(first.next_cursor))
+        self.assertEqual([p.body for p in second.items],
+                         ['post 5', 'post 4', 'post 3'])
+        back = buffer.page(3, after=decode_cursor(second.prev_cursor))
+        self.assertEqual([p.body for p in back.items],
+                         [p.body for p in first.items])
+        self.assertEqual(back.next_cursor, first.next_cursor)
+
+        # posts from other processes are found by the next sync
+        db.session.add(Post(body='elsewhere', author=u2,
+                            timestamp=now + timedelta(minutes=1)))
+        db.session.commit()
+        self.assertEqual(buffer.page(3).items[0].body, 'elsewhere')
+        self.assertEqual(len(buffer._posts), 4)
+
+        # two processes adding their own posts in turn still find each other's
+        buffers = [RecentPosts(100, 10 ** 6, 0, 300, None) for _ in range(2)]
+        for buffer in buffers:
+            buffer.warm()
+        for i in range(4):
+            post = Post(body='interleaved {}'.format(i), author=u2,
+                        timestamp=now + timedelta(minutes=2, seconds=i))
+            db.session.add(post)
+            db.session.commit()
+            buffers[i % 2].add(post, u2)
+        for buffer in buffers:
+            self.assertEqual([p.body for p in buffer.page(4).items],
+                             ['interleaved {}'.format(i) for i in (3, 2, 1, 0)])
+
+        # authors without a stored digest get the one of their email
+        mary = User(username='mary', email='mary@example.com')
+        db.session.add(mary)
+        db.session.commit()
+        buffer = buffers[0]
+        post = Post(body='from mary', author=mary,
+                    timestamp=now + timedelta(minutes=3))
+        db.session.add(post)
+        db.session.execute(User.__table__.update().values(avatar_hash=None))
+        db.session.commit()
+        buffer.add(post, mary)
+        buffer.update_author(u2)
+        avatars = {p.author.username: p.author.avatar(36)
+                   for p in buffer.page(2).items}
+        self.assertEqual(avatars, {'mary': mary.avatar(36),
+                                   'susan': u2.avatar(36)})
+        self.assertNotIn('None', avatars['mary'] + avatars['susan'])
+
+        # the memory cap wins over the number of posts
+        buffer = RecentPosts(100, 1500, 0, 300, None)
+        buffer.warm()
+        self.assertLess(len(buffer._posts), 10)
+        self.assertFalse(buffer.complete)
+
+    def test_sqlite_wal_profile(self):
+        tmp = tempfile.mkdtemp()
+        app.config['SQLITE_PROFILE'] = 'wal'
+        app.config['SQLALCHEMY_DATABASE_URI'] = \
+            'sqlite:///' + os.path.join(tmp, 'wal.db')
+        writer = db.engine
+        reader = db.readers[writer]
+        engines = []
+
+        def record(conn, *args):
+            engines.append(conn.engine)
+
+        try:
+            db.create_all()
+            u1 = User(username='john', email='john@example.com')
+            u1.set_password('cat')
+            u2 = User(username='susan', email='susan@example.com')
+            db.session.add_all([u1, u2])
+            db.session.commit()
+            self.assertEqual(
+                db.session.execute('PRAGMA journal_mode').scalar(), 'wal')
+            client = self.login('john')
+
+            event.listen(Engine, 'before_cursor_execute', record)
+            self.assertEqual(client.get('/explore').status_code, 200)
+            self.assertEqual(set(engines), {reader})
+            # the follow is written, then read back, by the writer
+            del engines[:]
+            client.get('/follow/susan')
+            self.assertEqual(engines[0], reader)
+            self.assertEqual(engines[-1], writer)
+            self.assertIn(b'1 followers', client.get('/user/susan').data)
+            with reader.connect() as conn:
+                self.assertEqual(conn.scalar('PRAGMA query_only'), 1)
+        finally:
+            event.remove(Engine, 'before_cursor_execute', record)
+            last_seen.flush()
+            db.session.remove()
+            writer.dispose()
+            reader.dispose()
+            app.config['SQLITE_PROFILE'] = 'default'
+            app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+            shutil.rmtree(tmp)
+
+    def test_read_replica(self):
+        tmp = tempfile.mkdtemp()
+        app.config['SQLALCHEMY_DATABASE_URI'] = \
+            'sqlite:///' + os.path.join(tmp, 'primary.db')
+        app.config['SQLALCHEMY_REPLICA_URI'] = \
+            'sqlite:///' + os.path.join(tmp, 'replica.db')
+        primary = db.engine
+        replica = db.readers[primary]
+        runner = app.test_cli_runner()
+        try:
+            db.create_all()
+            u1 = User(username='john', email='john@example.com')
+            u1.set_password('cat')
+            u2 = User(username='susan', email='susan@example.com')
+            u2.set_password('cat')
+            db.session.add_all([u1, u2, Post(body='old post', author=u2)])
+            db.session.commit()
+            self.assertIn('Replica updated.',
+                          runner.invoke(args=['replica', 'sync']).output)
+            db.session.add(Post(body='new post', author=u2))
+            db.session.commit()
+
+            # GET requests read from the replica, which has not seen the new post yet
+            john = self.login('john')
+            response = john.get('/user/susan')
+            self.assertIn(b'old post', response.data)
+            self.assertNotIn(b'new post', response.data)
+
+            # after writing, john reads from the primary
+            john.post('/index', data={'post': 'my post'})
+            self.assertIn(b'my post', john.get('/user/john').data)
+            self.assertIn(b'new post', john.get('/user/susan').data)
+
+            # but susan still reads from the replica until it catches up,
+            # gather() threads included
+            susan = self.login('susan')
+            for workers in (0, 2):
+                app.config['QUERY_WORKERS'] = workers
+                self.assertNotIn(b'my post', susan.get('/user/john').data)
+            runner.invoke(args=['replica', 'sync'])
+            self.assertIn(b'my post', susan.get('/user/john').data)
+        finally:
+            last_seen.flush()
+            db.session.remove()
+            primary.dispose()
+            replica.dispose()
+            app.config['SQLALCHEMY_REPLICA_URI'] = None
+            app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+            shutil.rmtree(tmp)
+
+    @unittest.skipIf(scipy is None, 'numpy and scipy are not installed')
+    def test_suggestions(self):
+        users = {name: User(username=name, email='{}@example.com'.format(name))
+                 for name in ('john', 'susan', 'david', 'mary', 'tom')}
+        users['john'].set_password('cat')
+        db.session.add_all(users.values())
+        for follower, followed in [('john', 'susan'), ('john', 'david'),
+                                   ('susan', 'mary'), ('susan', 'david'),
+                                   ('david', 'mary'), ('david', 'tom'),
+                                   ('mary', 'john')]:
+            users[follower].follow(users[followed])
+        db.session.commit()
+
+        # friends of friends, by number of mutual follows, not already followed
+        report = compute_suggestions(k=20, block_size=2)
+        self.assertEqual(report['edges'], 7)
+        john = User.query.filter_by(username='john').first()
+        self.assertEqual([(u.username, score)
+                          for u, score in john.suggested_users(5)],
+                         [('mary', 2), ('tom', 1)])
+        self.assertEqual([u.username for u, _ in john.suggested_users(1)],
+                         ['mary'])
+
+        client = self.login('john')
+        response = client.get('/index')
+        self.assertIn(b'Who to follow', response.data)
+        self.assertIn(b'Followed by 2 people you follow', response.data)
+        client.get('/follow/mary')
+        response = client.get('/index')
+        self.assertNotIn(b'Followed by 2 people you follow', response.data)
+        self.assertIn(b'/follow/tom', response.data)
+        self.assertNotIn(b'Who to follow', client.get('/user/tom').data)
+
+    def test_parallel_user_page(self):
+        u1 = User(username='john', email='john@example.com')
+        u1.set_password('cat')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.add_all([Post(body='post {}'.format(i), author=u2)
+                            for i in range(4)])
+        u1.follow(u2)
+        db.session.commit()
+        client = self.login('john')
+
+        pages = []
+        for workers in (0, 2):
+            app.config['QUERY_WORKERS'] = workers
+            follow_cache.clear()
+            fragment_cache.local.clear()
+            response = client.get('/user/susan')
+            self.assertEqual(response.status_code, 200)
+            pages.append(response.data)
+        self.assertIn(b'1 followers, 0 following.', pages[1])
+        self.assertIn(b'/unfollow/susan', pages[1])
+        self.assertIn(b'post 3', pages[1])
+        self.assertEqual(pages[0], pages[1])
+
+        with app.test_request_context():
+            g.sql = RequestStats()
+            posts, count = gather(lambda: Post.query.all(),
+                                  lambda: Post.query.count())
+            self.assertEqual(count, 4)
+            self.assertEqual(g.sql.queries, 2)
+            posts = adopt(posts)
+            self.assertEqual(posts[0].author.username, 'susan')
+
+    def test_search(self):
+        u = User(username='john', email='john@example.com')
+        u.set_password('cat')
+        db.session.add(u)
+        now = datetime.utcnow()
+        bodies = ['the cat sat on the mat', 'a dog and a cat', 'cat cat cat',
+                  'just a dog', '100% "cat" OR dog']
+        for i, body in enumerate(bodies):
+            post = Post(body=body, author=u, timestamp=now + timedelta(seconds=i))
+            db.session.add(post)
+            add_to_index(post)
+        db.session.commit()
+
+        for backend in ('sqlite', 'like'):
+            app.config['SEARCH_BACKEND'] = backend
+            posts, has_next = query_index('cat', 1, 10)
+            self.assertEqual(len(posts), 4, backend)
+            self.assertFalse(has_next)
+            posts, has_next = query_index('dog cat', 1, 1)
+            self.assertEqual(len(posts), 1, backend)
+            self.assertTrue(has_next)
+            self.assertEqual(query_index('"cat" OR', 1, 10)[0][0].body,
+                             bodies[4])
+        # bm25 ranks the post that is all about cats first
+        app.config['SEARCH_BACKEND'] = 'sqlite'
+        self.assertEqual(query_index('cat', 1, 10)[0][0].body, 'cat cat cat')
+
+        response = self.login('john').get('/search?q=dog')
+        self.assertIn(b'just a dog', response.data)
+        self.assertNotIn(b'cat cat cat', response.data)
+
+    def test_fragment_cache(self):
+        u = User(username='john', email='john@example.com')
+        u.set_password('cat')
+        db.session.add(u)
+        db.session.add_all([Post(body='post {}'.format(i), author=u)
+                            for i in range(3)])
+        db.session.commit()
+        client = self.login('john')
+
+        response = client.get('/user/john')
+        self.assertEqual(response.headers['X-Fragment-Cache'],
+                         'hits=0, misses=3')
+        response = client.get('/explore')
+        self.assertEqual(response.headers['X-Fragment-Cache'],
+                         'hits=3, misses=0')
+        self.assertNotIn('X-Page-Cache', response.headers)
+
+        # a new username must show up in the cached posts
+        client.post('/edit_profile', data={'username': 'johnny',
+                                           'about_me': ''})
+        response = client.get('/user/johnny')
+        self.assertEqual(response.headers['X-Fragment-Cache'],
+                         'hits=0, misses=3')
+        self.assertNotIn(b'/user/john"', response.data)
+
+        app.config['PAGE_CACHE_TTL'] = 60
+        self.assertEqual(client.get('/explore').headers['X-Page-Cache'], 'MISS')
+        response = client.get('/explore')
+        self.assertEqual(response.headers['X-Page-Cache'], 'HIT')
+        self.assertIn(b'post 2', response.data)
+
+    def test_conditional_get(self):
+        u1 = User(username='john', email='john@example.com')
+        u1.set_password('cat')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.add(Post(body='post from susan', author=u2,
+                            timestamp=datetime.utcnow() - timedelta(days=1)))
+        db.session.add(Post(body='post from john', author=u1,
+                            timestamp=datetime.utcnow() - timedelta(days=2)))
+        db.session.commit()
+        client = self.login('john')
+
+        for url in ('/index', '/explore', '/user/susan'):
+            response = client.get(url)
+            self.assertEqual(response.status_code, 200)
+            etag = response.headers['ETag']
+            # the pages show counts and usernames that change without a new post
+            self.assertNotIn('Last-Modified', response.headers)
+            # the post page query (with its ORDER BY) is not even run
+            response, n = self.count_queries(
+                lambda: client.get(url, headers={'If-None-Match': etag}),
+                'ORDER BY')
+            self.assertEqual((response.status_code, n), (304, 0), url)
+            self.assertEqual(response.data, b'')
+            response = client.get(url, headers={
+                'If-Modified-Since': 'Fri, 01 Jan 2100 00:00:00 GMT'})
+            self.assertEqual(response.status_code, 200, url)
+
+        # the validator and the view share the user of a profile page
+        response, n = self.count_queries(lambda: client.get('/user/susan'),
+                                         'user.username = ')
+        self.assertEqual((response.status_code, n), (200, 1))
+
+        # following susan brings her post to john's home page
+        etag = client.get('/index').headers['ETag']
+        client.get('/follow/susan')
+        response = client.get('/index', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'post from susan', response.data)
+        for model in ('pull', 'fanout'):
+            app.config['TIMELINE_MODEL'] = model
+            rebuild_timelines()
+            newest = Post.query.filter_by(body='post from susan').one()
+            self.assertEqual(User.query.get(u1.id).newest_followed_post(),
+                             newest.timestamp, model)
+        app.config['TIMELINE_MODEL'] = 'pull'
+
+        # a new post changes explore
+        etag = client.get('/explore').headers['ETag']
+        client.post('/index', data={'post': 'hello'})
+        response = client.get('/explore', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+
+    def test_api_streams(self):
+        u1 = User(username='john', email='john@example.com')
+        u1.set_password('cat')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        now = datetime.utcnow()
+        for i in range(5):
+            db.session.add(Post(body='post {}'.format(i),
+                                author=u1 if i % 2 else u2,
+                                timestamp=now + timedelta(seconds=i)))
+        u1.follow(u2)
+        db.session.commit()
+        client = self.login('john')
+
+        for model in ('pull', 'fanout'):
+            app.config['TIMELINE_MODEL'] = model
+            rebuild_timelines()
+            response = client.get('/api/timeline?limit=3')
+            self.assertEqual(response.mimetype, 'application/x-ndjson')
+            items = [json.loads(line)
+                     for line in response.data.decode().splitlines()]
+            self.assertEqual([p['body'] for p in items],
+                             ['post 4', 'post 3', 'post 2'])
+            response = client.get('/api/timeline?before=' + items[-1]['cursor'])
+            items = [json.loads(line)
+                     for line in response.data.decode().splitlines()]
+            self.assertEqual([p['body'] for p in items], ['post 1', 'post 0'])
+
+        items = json.loads(client.get(
+            '/api/users/john/posts?format=json').data.decode())
+        self.assertEqual([p['body'] for p in items], ['post 3', 'post 1'])
+        self.assertEqual(items[0]['author']['username'], 'john')
+        self.assertEqual(items[0]['author']['avatar'], u1.avatar(128))
+        self.assertEqual(json.loads(client.get(
+            '/api/explore?format=json&limit=1').data.decode())[0]['body'],
+            'post 4')
+        items = json.loads(client.get(
+            '/api/users/susan/followers?format=json').data.decode())
+        self.assertEqual([u['username'] for u in items], ['john'])
+        self.assertEqual(client.get('/api/users/susan/followed').data, b'')
+
+        # users whose avatar digest has not been stored yet
+        db.session.execute(User.__table__.update().values(avatar_hash=None))
+        db.session.commit()
+        items = json.loads(client.get(
+            '/api/users/susan/followers?format=json').data.decode())
+        self.assertEqual(items[0]['avatar'],
+                         User(email='john@example.com').avatar(128))
+        items = json.loads(client.get(
+            '/api/users/john/posts?format=json').data.decode())
+        self.assertEqual(items[0]['author']['avatar'],
+                         User(email='john@example.com').avatar(128))
+
+    def test_data_import_export(self):
+        u1 = User(username='john', email='john@example.com', about_me='hi')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.add_all([Post(body='post {}'.format(i), author=u2)
+                            for i in range(5)])
+        u1.follow(u2)
+        db.session.commit()
+        runner = app.test_cli_runner()
+
+        with tempfile.TemporaryDirectory() as tmp:
+            files = {'users': 'users.csv', 'posts': 'posts.ndjson',
+                     'followers': 'followers.csv'}
+            for table, name in files.items():
+                result = runner.invoke(args=['data', 'export', table,
+                                             os.path.join(tmp, name)])
+                self.assertEqual(result.exit_code, 0, result.output)
+            db.session.remove()
+            db.drop_all()
+            db.create_all()
+            for table, name in files.items():
+                result = runner.invoke(args=[
+                    'data', 'import', table, os.path.join(tmp, name),
+                    '--batch-size', '2', '--defer-indexes'])
+                self.assertEqual(result.exit_code, 0, result.output)
+                self.assertIn('rows/s', result.output)
+
+        u1, u2 = User.query.order_by(User.id).all()
+        self.assertEqual((u1.username, u1.about_me, u2.about_me),
+                         ('john', 'hi', None))
+        self.assertEqual(u1.avatar_hash, 'd4c74594d841139328695756648b6bd6')
+        self.assertEqual(u1.followed.all(), [u2])
+        self.assertEqual(u2.posts.count(), 5)
+        self.assertEqual(len(query_index('post', 1, 10)[0]), 5)
+
+    def test_sql_instrumentation(self):
+        users = [User(username='user{}'.format(i),
+                      email='user{}@example.com'.format(i)) for i in range(6)]
+        users[0].set_password('cat')
+        db.session.add_all(users)
+        db.session.add_all([Post(body='post', author=u) for u in users])
+        db.session.commit()
+        client = self.login('user0')
+
+        timing = client.get('/explore').headers['Server-Timing']
+        self.assertRegex(timing, r'^db;dur=[0-9.]+;desc="\d+ queries", '
+                                 r'db-slowest;dur=[0-9.]+, app;dur=[0-9.]+$')
+        self.assertEqual(client.get('/metrics').status_code, 404)
+        app.config['METRICS_TOKEN'] = 'scraper'
+        self.assertEqual(client.get('/metrics').status_code, 403)
+        self.assertEqual(client.get('/metrics', headers={
+            'Authorization': 'Bearer wrong'}).status_code, 403)
+        metrics = self.get_metrics(client)
+        self.assertIn('microblog_sql_sampled_requests_total{endpoint="explore"} 1',
+                      metrics)
+        self.assertIn('microblog_sql_n_plus_one_requests_total'
+                      '{endpoint="explore"} 0', metrics)
+        self.assertIn('microblog_mail_queue_depth 0', metrics)
+        self.assertIn('microblog_fragment_cache_total'
+                      '{endpoint="explore",result="misses"}', metrics)
+
+        # loading the authors one by one is an N+1 pattern
+        db.session.expire_all()
+        with app.test_request_context():
+            g.sql = RequestStats()
+            for post in Post.query.all():
+                post.author.username
+            self.assertEqual(g.sql.queries, 7)
+            self.assertEqual(list(g.sql.repeated(5).values()), [6])
+
+        app.config['SQL_METRICS_SAMPLE_RATE'] = 0
+        self.assertNotIn('Server-Timing', client.get('/explore').headers)
+
+    def test_profiling(self):
+        u = User(username='admin', email=app.config['ADMINS'][0])
+        u.set_password('cat')
+        db.session.add(u)
+        db.session.commit()
+        app.config['PROFILING_ENABLED'] = True
+        app.config['PROFILING_TOKEN'] = 'secret'
+        try:
+            with tempfile.TemporaryDirectory() as tmp:
+                app.config['PROFILE_DIR'] = tmp
+                client = self.login('admin')
+                response = client.get('/explore')
+                self.assertIn('template;dur=', response.headers['Server-Timing'])
+                response = client.post('/index', data={'post': 'hello'})
+                self.assertIn('forms;dur=', response.headers['Server-Timing'])
+                metrics = self.get_metrics(client)
+                self.assertIn('microblog_request_phase_seconds_count'
+                              '{endpoint="login",phase="hashing"} 1', metrics)
+                self.assertIn('microblog_request_seconds_bucket'
+                              '{endpoint="explore",le="+Inf"} 1', metrics)
+
+                # a wrong token is ignored
+                response = client.get('/explore', headers={
+                    'X-Profile': 'cprofile', 'X-Profile-Token': 'wrong'})
+                self.assertNotIn('X-Profile-Dump', response.headers)
+                response = client.get('/explore', headers={
+                    'X-Profile': 'cprofile', 'X-Profile-Token': 'secret'})
+                name = response.headers['X-Profile-Dump']
+                stats = pstats.Stats(os.path.join(tmp, name))
+                self.assertTrue(any(func[2] == 'explore'
+                                    for func in stats.stats))
+
+                self.assertEqual(client.get('/admin/profile').status_code, 200)
+                response = client.post('/admin/profile', data={
+                    'mode': 'sample', 'path': '/user/', 'count': 0})
+                self.assertIn(b'has-error', response.data)
+                response = client.post('/admin/profile', data={
+                    'mode': 'sample', 'path': '/user/', 'count': 1})
+                self.assertEqual(response.status_code, 302)
+                self.assertNotIn('X-Profile-Dump',
+                                 client.get('/explore').headers)
+                name = client.get('/user/admin').headers['X-Profile-Dump']
+                self.assertTrue(name.endswith('-user-admin.collapsed'))
+                self.assertNotIn('X-Profile-Dump',
+                                 client.get('/user/admin').headers)
+                self.assertEqual(
+                    client.get('/admin/profiles').get_json()['profiles'],
+                    sorted(os.listdir(tmp)))
+        finally:
+            app.config['PROFILING_ENABLED'] = False
+            app.config['PROFILING_TOKEN'] = None
+        self.assertEqual(client.get('/admin/profiles').status_code, 404)
+
+
+@unittest.skipIf(smtpd is None, 'smtpd is not available')
+class MailWorkerPoolCase(unittest.TestCase):
+    def setUp(self):
+        self.received = []
+        self.connections = 0
+        case = self
+
+        class Server(smtpd.SMTPServer):
+            def handle_accepted(self, conn, addr):
+                case.connections += 1
+                super().handle_accepted(conn, addr)
+
+            def process_message(self, peer, mailfrom, rcpttos, data, **kw):
+                case.received.append((rcpttos, data))
+
+        self.server = Server(('127.0.0.1', 0), None)
+        self.thread = threading.Thread(
+            target=asyncore.loop, kwargs={'timeout': 0.05}, daemon=True)
+        self.thread.start()
+        self.state = app.extensions['mail']
+        self.saved = (self.state.server, self.state.port, self.state.suppress)
+        self.state.server = '127.0.0.1'
+        self.state.port = self.server.socket.getsockname()[1]
+        self.state.suppress = False
+
+    def tearDown(self):
+        self.state.server, self.state.port, self.state.suppress = self.saved
+        self.server.close()
+        self.thread.join()
+
+    def message(self, i):
+        return Message('hello', sender='admin@example.com',
+                       recipients=['user{}@example.com'.format(i)], body='hi')
+
+    def test_batches_on_one_connection(self):
+        pool = MailWorkerPool(workers=1, maxsize=100, batch_size=10,
+                              retries=0, backoff=0, idle_timeout=0.1)
+        for i in range(25):
+            pool.submit(self.message(i))
+        pool.join()
+        self.assertEqual(len(self.received), 25)
+        metrics = pool.metrics()
+        self.assertEqual(metrics['sent'], 25)
+        self.assertEqual(metrics['queue_depth'], 0)
+        self.assertEqual(metrics['connections'], 1)
+        self.assertEqual(self.connections, 1)
+
+    def test_template_email_rendered_by_worker(self):
+        pool = MailWorkerPool(workers=1, maxsize=10, batch_size=10,
+                              retries=0, backoff=0, idle_timeout=0.1)
+        users = [User(id=i, username='user{}'.format(i),
+                      email='user{}@example.com'.format(i)) for i in range(5)]
+        pool.submit(TemplateEmail(
+            '[Microblog] Reset Your Password', 'admin@example.com',
+            'email/reset_password', password_reset_recipients(users),
+            'http://microblog.example.com/'))
+        pool.join()
+        self.assertEqual(pool.metrics()['sent'], 5)
+        self.assertEqual(self.connections, 1)
+        for i, (rcpttos, data) in enumerate(self.received):
+            self.assertEqual(rcpttos, ['user{}@example.com'.format(i)])
+            self.assertIn('Dear user{}'.format(i).encode(), data)
+            self.assertIn(b'http://microblog.example.com/reset_password/', data)
+
+    def test_retry_and_backpressure(self):
+        self.state.port = 1  # nothing listens there
+        pool = MailWorkerPool(workers=1, maxsize=1, batch_size=1,
+                              retries=2, backoff=0.01, idle_timeout=5)
+        pool.submit(self.message(0))
+        pool.join()
+        self.assertEqual(pool.metrics()['retries'], 2)
+        self.assertEqual(pool.metrics()['failed'], 1)
+
+        # without workers nobody drains the queue
+        blocked = MailWorkerPool(workers=0, maxsize=1, batch_size=1,
+                                 retries=0, backoff=0, idle_timeout=5)
+        blocked.submit(self.message(1))
+        self.assertRaises(MailQueueFull, blocked.submit, self.message(2),
+                          timeout=0.01)
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
\ No newline at end of file